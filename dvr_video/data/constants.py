@@ -2,6 +2,15 @@ DATE_FORMAT = "%y%m%d%H%M%S"
 VIDEO_FILE_EXTENSION = ".mp4"
 PHOTO_FILE_EXTENSION = ".jpg"
 DIR_NAME = "/etc/mdvr/materials"
+# staging for files being recorded, inside DIR_NAME so publishing is an atomic rename
+TEMP_DIR = "/etc/mdvr/materials/.staging"
+LEGACY_TEMP_DIR = "temp"
+INDEX_FILE = "/etc/mdvr/materials.db"
+# dvr_web rescans the materials directory for files changed by hand at most this often, in seconds
+MATERIALS_RESCAN_INTERVAL = 60
+MATERIALS_LAYOUT_FLAT = 'flat'
+MATERIALS_LAYOUT_PARTITIONED = 'partitioned'
+PARTITION_DATE_FORMAT = "%y%m%d"
 VPN_DNS = '10.99.97.1'
 VIDEO_OPTIONS_KEY = 'video_options'
 RTSP_OPTIONS_KEY = 'rtsp_options'
@@ -15,3 +24,58 @@ CONFIG_FILENAME = 'data_config.json'
 LOG_DIR = "/etc/mdvr/logs"
 BTN_A_PIN = 22
 BTN_B_PIN = 23
+SEGMENT_POLL_INTERVAL = 1
+CAMERA_RESTART_DELAY = 5
+CAMERA_BACKOFF_MAX = 300
+WATCHDOG_INTERVAL = 10
+CAMERA_STALL_GRACE = 60
+RECORD_MODE_AUTO = 'auto'
+RECORD_MODE_COPY = 'copy'
+RECORD_MODE_TRANSCODE = 'transcode'
+COPY_CODECS = ('h264', 'hevc')
+# seconds before a camera that could not be probed is probed again, it records in transcode mode meanwhile
+RECORD_MODE_PROBE_RETRY = 600
+PREROLL_DIR = "/dev/shm/mdvr_preroll"
+# event segments spilled from the pre-roll ring, on the card next to staging and counted by the space guard
+PREROLL_SPILL_DIR = "/etc/mdvr/materials/.events"
+LEGACY_PREROLL_SPILL_DIR = "events"
+PREROLL_SEGMENT_SECONDS = 2
+STATS_FILE = "/run/mdvr/engine_stats.json"
+STATS_INTERVAL = 5
+STATS_WINDOW = 10
+FINALIZE_BATCH_SIZE = 16
+FINALIZE_BATCH_DELAY = 1
+SPACE_GUARD_INTERVAL = 30
+SPACE_GUARD_DEBOUNCE = 2000
+# retention classes of materials, evicted in the order of the "retention" config section
+RETENTION_CONTINUOUS = 'continuous'
+RETENTION_EVENT = 'event'
+RETENTION_PHOTO = 'photo'
+# reserve this much more than the forecast of the next segment round
+RESERVE_MARGIN = 1.5
+THUMBNAIL_DIR = "/etc/mdvr/thumbnails"
+THUMBNAIL_CACHE_MB = 256
+THUMBNAIL_WIDTH = 320
+SPRITE_TILES = 10
+# fragmented mp4 stays playable while written and after a crash, faststart moves moov to the front on close
+FRAGMENTED_MOVFLAGS = '+frag_keyframe+empty_moov+default_base_moof'
+FASTSTART_MOVFLAGS = '+faststart'
+FTP_TUNING_FILE = "/etc/mdvr/ftp_tuning.json"
+FTP_MAX_CONNECTIONS = 4
+# seconds of uploading behind each auto-tuning decision
+FTP_TUNE_WINDOW = 20
+UPLOAD_JOURNAL_FILE = "/etc/mdvr/uploads.db"
+# resume progress is written to the journal every this many bytes
+UPLOAD_PROGRESS_BYTES = 4 * 1024 * 1024
+# upload order, lower index goes first
+UPLOAD_PRIORITY = (RETENTION_EVENT, RETENTION_PHOTO, RETENTION_CONTINUOUS, 'logs')
+# seconds between looks at the index for materials recorded while uploading
+FTP_REFILL_INTERVAL = 30
+UPLOAD_STATS_FILE = "/run/mdvr/upload_stats.json"
+UPLOAD_LATENCY_INTERVAL = 10
+# VPN round trips above this many times the baseline slow the upload down
+UPLOAD_LATENCY_FACTOR = 2
+UPLOAD_MIN_RATE_KBPS = 32
+# failed uploads are retried after 30 s, 60 s, 120 s ... at most an hour apart
+UPLOAD_RETRY_BASE = 30
+UPLOAD_RETRY_MAX = 3600
@@ -0,0 +1,162 @@
+import heapq
+import os
+import time
+
+from collections.abc import Iterable
+
+from .constants import RETENTION_CONTINUOUS, RETENTION_EVENT, RETENTION_PHOTO, PHOTO_FILE_EXTENSION
+from .utils import parse_material_name
+
+
+class EvictionReport:
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def __str__(self):
+        return f"{self.files} files, {self.bytes} bytes freed in {self.seconds:.2f}s"
+
+
+def retention_class(kind: str, event_id: str | None) -> str:
+    if kind == 'photo':
+        return RETENTION_PHOTO
+    return RETENTION_EVENT if event_id else RETENTION_CONTINUOUS
+
+
+class RetentionPolicy:
+    """
+    Eviction order from the "retention" config section:
+
+        {"continuous": {"priority": 0, "quota_gb": 0, "min_age_hours": 0},
+         "photo": {...}, "event": {...}, "camera_priority": [0, 0, 0, 0]}
+
+    The lowest class priority is drained first, then the lowest camera priority, then the oldest file.
+    A class with quota_gb above 0 never keeps more than that, its oldest files go first whatever the
+    total usage. Files younger than min_age_hours of their class are never evicted.
+    """
+
+    def __init__(self, options: dict | None = None):
+        options = options or {}
+        self.classes = {name: options.get(name) or {}
+                        for name in (RETENTION_CONTINUOUS, RETENTION_PHOTO, RETENTION_EVENT)}
+        self.camera_priority = options.get('camera_priority') or []
+
+    def priority(self, name: str) -> int:
+        return int(self.classes[name].get('priority', 0))
+
+    def quota(self, name: str) -> int:
+        return int(float(self.classes[name].get('quota_gb', 0)) * 1_000_000_000)
+
+    def min_age(self, name: str) -> float:
+        return float(self.classes[name].get('min_age_hours', 0)) * 3600
+
+    def camera(self, camera: int | None) -> int:
+        if camera is None or not 0 < camera <= len(self.camera_priority):
+            return 0
+        return int(self.camera_priority[camera - 1])
+
+    def over_quota(self, usage: dict[str, int]) -> list[str]:
+        return [name for name, used in usage.items() if 0 < self.quota(name) < used]
+
+    def plan(self, candidates: Iterable[tuple], now: float) -> tuple[list[tuple[str, int]], list[tuple]]:
+        """
+        Splits (start_ts, path, size, camera, kind, event_id) candidates into files that exceed their class
+        quota, oldest first, and heap entries (class priority, camera priority, start_ts, path, size) for the rest.
+        """
+        by_class = {name: [] for name in self.classes}
+        for start_ts, path, size, camera, kind, event_id in candidates:
+            by_class[retention_class(kind, event_id)].append((start_ts, path, size, camera))
+
+        forced, ordered = [], []
+        for name, files in by_class.items():
+            quota, newest = self.quota(name), now - self.min_age(name)
+            excess = sum(size for _, _, size, _ in files) - quota if quota else 0
+            if excess > 0:
+                files.sort()
+            for start_ts, path, size, camera in files:
+                if start_ts > newest:
+                    continue
+                if excess > 0:
+                    forced.append((path, size))
+                    excess -= size
+                else:
+                    ordered.append((self.priority(name), self.camera(camera), start_ts, path, size))
+        return forced, ordered
+
+
+def scan_candidates(directory: str, skip: str | None = None) -> tuple[list[tuple], int]:
+    """
+    One pass over directory and its subdirectories. Returns (start_ts, path, size, camera, kind, event_id)
+    of every file and the total size. Files under skip (the staging directory) and other dot directories
+    (spilled event segments) count towards the total but are never candidates.
+    """
+    candidates, total = [], 0
+    stack = [(directory, True)]
+    while stack:
+        path, evictable = stack.pop()
+        try:
+            it = os.scandir(path)
+        except FileNotFoundError:
+            continue
+        with it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append((entry.path, evictable and entry.path != skip
+                                      and not entry.name.startswith('.')))
+                        continue
+                    if not entry.is_file(follow_symlinks=False):
+                        continue
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+
+                total += stat.st_size
+                if evictable:
+                    parsed = parse_material_name(entry.name)
+                    camera, start, event_id = parsed if parsed else (None, None, None)
+                    start_ts = int(start.timestamp()) if start else int(stat.st_mtime)
+                    kind = 'photo' if entry.name.endswith(PHOTO_FILE_EXTENSION) else 'video'
+                    candidates.append((start_ts, entry.path, stat.st_size, camera, kind, event_id))
+    return candidates, total
+
+
+def evict(candidates: Iterable[tuple], used: int, target: int, logger, policy: RetentionPolicy | None = None,
+          on_removed=None) -> EvictionReport:
+    """
+    Removes files over their class quota, then the lowest ranked candidates until used drops to target.
+    Candidates are (start_ts, path, size, camera, kind, event_id), the byte count is updated from their
+    sizes so nothing is rescanned between deletes. on_removed(path) is called for every removed file.
+    """
+    report = EvictionReport()
+    started = time.monotonic()
+    forced, heap = (policy or RetentionPolicy()).plan(candidates, time.time())
+
+    def remove(path: str, size: int) -> bool:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # removed by someone else, the space is free anyway
+        except OSError as e:
+            logger.error(f"Failed to remove {path}: {e}")
+            return False
+        else:
+            report.files += 1
+            report.bytes += size
+        if on_removed is not None:
+            on_removed(path)
+        return True
+
+    for path, size in forced:
+        if remove(path, size):
+            used -= size
+
+    heapq.heapify(heap)
+    while used > target and heap:
+        *_, path, size = heapq.heappop(heap)
+        if remove(path, size):
+            used -= size
+
+    report.seconds = time.monotonic() - started
+    return report
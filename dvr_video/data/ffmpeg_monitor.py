@@ -0,0 +1,194 @@
+import asyncio
+import logging
+import os
+import selectors
+import threading
+import time
+
+from .utils import is_ffmpeg_error_line
+
+PROGRESS_ARGS = ['-progress', 'pipe:1', '-nostats']
+
+
+def with_progress(args: list[str]) -> list[str]:
+    """Adds machine-readable progress on stdout to a compiled ffmpeg command."""
+    return [args[0], *PROGRESS_ARGS, *args[1:]]
+
+
+def _to_float(value: str) -> float | None:
+    # "1024.3kbits/s", "1.01x", "15.00", "N/A"
+    try:
+        return float(value.rstrip('kbits/sx'))
+    except ValueError:
+        return None
+
+
+def _to_int(value: str) -> int | None:
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+class FfmpegProgress:
+    """Latest counters of one ffmpeg process, updated from its -progress blocks."""
+
+    def __init__(self):
+        self.frame = 0
+        self.fps = None
+        self.bitrate_kbps = None
+        self.speed = None
+        self.total_size = 0
+        self.out_time_us = 0
+        self.dup_frames = 0
+        self.drop_frames = 0
+        self._block_frame = 0
+        self._block_out_time = 0
+        self.started = time.monotonic()
+        self.first_frame = None  # monotonic time of the first progress block with frames
+        self.updated = None
+        self.advanced = None  # monotonic time of the last block that wrote frames, None before the first one
+        self.finished = False
+
+    def update(self, key: str, value: str):
+        if key == 'frame':
+            self.frame = _to_int(value) or 0
+        elif key == 'fps':
+            self.fps = _to_float(value)
+        elif key == 'bitrate':
+            self.bitrate_kbps = _to_float(value)
+        elif key == 'speed':
+            self.speed = _to_float(value)
+        elif key == 'total_size':
+            self.total_size = _to_int(value) or self.total_size
+        elif key == 'out_time_us':
+            self.out_time_us = _to_int(value) or self.out_time_us
+        elif key == 'dup_frames':
+            self.dup_frames = _to_int(value) or 0
+        elif key == 'drop_frames':
+            self.drop_frames = _to_int(value) or 0
+        elif key == 'progress':
+            # "continue" or "end" closes one block
+            self.updated = time.monotonic()
+            self.finished = value == 'end'
+            if self.first_frame is None and self.frame:
+                self.first_frame = self.updated
+            if self.frame > self._block_frame or self.out_time_us > self._block_out_time:
+                self.advanced = self.updated
+            self._block_frame, self._block_out_time = self.frame, self.out_time_us
+
+    def stalled_for(self) -> float:
+        """Seconds since ffmpeg last wrote frames, or since it started if it has not yet."""
+        return time.monotonic() - (self.advanced or self.started)
+
+    def as_dict(self) -> dict:
+        return {
+            "frame": self.frame,
+            "fps": self.fps,
+            "bitrate_kbps": self.bitrate_kbps,
+            "speed": self.speed,
+            "total_size": self.total_size,
+            "out_time": self.out_time_us / 1_000_000,
+            "dup_frames": self.dup_frames,
+            "drop_frames": self.drop_frames,
+        }
+
+
+class _LineBuffer:
+    def __init__(self):
+        self.pending = b''
+
+    def feed(self, data: bytes) -> list[str]:
+        # ffmpeg ends its status lines with \r, so split on both
+        lines = (self.pending + data).replace(b'\r', b'\n').split(b'\n')
+        self.pending = lines.pop()
+        return [raw.decode('utf-8', errors='replace').strip() for raw in lines]
+
+
+class FfmpegMonitor:
+    """
+    Reads stderr and -progress output of every ffmpeg process without a thread per camera.
+
+    Processes started with asyncio are watched with `await watch(name, proc)`. Popen processes
+    (ffmpeg.run_async) are attach()ed to a single selector thread shared by all of them.
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.debug = logger.isEnabledFor(logging.DEBUG)
+        self.progress: dict[str, FfmpegProgress] = {}
+        self._selector = None
+        self._wakeup = None
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def _handle_stderr(self, name: str, lines: list[str]):
+        for line in lines:
+            if not line:
+                continue
+            if self.debug:
+                self.logger.debug(f"[ffmpeg {name}] {line}")
+            if is_ffmpeg_error_line(line):
+                self.logger.error(f"FFMPEG ERROR [{name}]: {line}")
+
+    def _handle_progress(self, name: str, lines: list[str]):
+        progress = self.progress[name]
+        for line in lines:
+            key, sep, value = line.partition('=')
+            if sep:
+                progress.update(key, value.strip())
+
+    async def watch(self, name: str, proc):
+        """Consumes both pipes of an asyncio subprocess until it closes them."""
+        self.progress[name] = FfmpegProgress()
+
+        async def pump(stream, handle):
+            if stream is None:
+                return
+            buffer = _LineBuffer()
+            while chunk := await stream.read(4096):
+                handle(name, buffer.feed(chunk))
+
+        await asyncio.gather(pump(proc.stderr, self._handle_stderr),
+                             pump(proc.stdout, self._handle_progress))
+
+    def attach(self, name: str, proc):
+        """Registers the pipes of a Popen process with the shared selector thread."""
+        self.progress[name] = FfmpegProgress()
+        with self._lock:
+            if self._selector is None:
+                self._start()
+            for pipe, handle in ((proc.stderr, self._handle_stderr), (proc.stdout, self._handle_progress)):
+                if pipe is not None:
+                    self._pending.append((pipe, (name, handle, _LineBuffer())))
+        os.write(self._wakeup[1], b'\0')
+
+    def _start(self):
+        self._selector = selectors.DefaultSelector()
+        self._wakeup = os.pipe()
+        self._selector.register(self._wakeup[0], selectors.EVENT_READ)
+        threading.Thread(target=self._run, name='ffmpeg-monitor', daemon=True).start()
+
+    def _run(self):
+        while True:
+            for key, _ in self._selector.select():
+                if key.data is None:
+                    os.read(self._wakeup[0], 512)
+                    with self._lock:
+                        pending, self._pending = self._pending, []
+                    for pipe, data in pending:
+                        try:
+                            self._selector.register(pipe, selectors.EVENT_READ, data)
+                        except (ValueError, OSError):
+                            pass  # the pipe was closed before the thread got to it
+                    continue
+
+                name, handle, buffer = key.data
+                try:
+                    chunk = os.read(key.fd, 4096)
+                except OSError:
+                    chunk = b''
+                if not chunk:
+                    self._selector.unregister(key.fileobj)
+                    continue
+                handle(name, buffer.feed(chunk))
@@ -0,0 +1,130 @@
+import os
+import queue
+import shutil
+import threading
+
+from .constants import DIR_NAME, TEMP_DIR, LEGACY_TEMP_DIR, FINALIZE_BATCH_SIZE, FINALIZE_BATCH_DELAY
+from .utils import material_relpath
+
+
+class SegmentFinalizer:
+    """
+    Publishes closed recordings from the staging directory into the materials directory.
+
+    Staging lives inside the materials directory, so publishing is an atomic rename and never a copy.
+    Files are handled in batches by one worker thread: every file of the batch is fsynced, renamed,
+    then each target directory is fsynced once, and finally subscribers (indexers, uploaders, metrics) are
+    called with the published path. With partitioned set files go to DIR_NAME/yymmdd/camN/.
+    """
+
+    def __init__(self, logger, batch_size: int = FINALIZE_BATCH_SIZE, batch_delay: float = FINALIZE_BATCH_DELAY,
+                 partitioned: bool = False):
+        self.logger = logger
+        self.partitioned = partitioned
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._subscribers = []
+        self._thread = None
+
+    def subscribe(self, callback):
+        """callback(path) is called from the worker thread for every published file."""
+        self._subscribers.append(callback)
+
+    def start(self):
+        os.makedirs(TEMP_DIR, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name='segment-finalizer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Publishes everything submitted so far and stops the worker."""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, paths: list[str]):
+        with self._lock:
+            for path in paths:
+                if path not in self._pending:
+                    self._pending.add(path)
+                    self._queue.put(path)
+
+    def recover(self):
+        """Submits recordings left in staging (or the old relative temp directory) by a previous run."""
+        if os.path.isdir(LEGACY_TEMP_DIR):
+            for name in os.listdir(LEGACY_TEMP_DIR):
+                shutil.move(os.path.join(LEGACY_TEMP_DIR, name), os.path.join(TEMP_DIR, name))
+
+        self.submit([os.path.join(TEMP_DIR, name) for name in sorted(os.listdir(TEMP_DIR))])
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self._queue.get(timeout=self.batch_delay))
+            except queue.Empty:
+                pass
+
+            if None in batch:
+                stopping = True
+                batch = [path for path in batch if path is not None]
+
+            # anything submitted while stopping is still published
+            while stopping:
+                try:
+                    path = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if path is not None:
+                    batch.append(path)
+
+            for path in self._publish(batch):
+                for callback in self._subscribers:
+                    try:
+                        callback(path)
+                    except Exception as e:
+                        self.logger.error(f"Finalize subscriber failed for {path}: {e}")
+
+    def _publish(self, batch: list[str]) -> list[str]:
+        published = []
+        directories = set()
+        for path in batch:
+            target = os.path.join(DIR_NAME, material_relpath(os.path.basename(path), self.partitioned))
+            try:
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                directory = os.path.dirname(target)
+                if not os.path.isdir(directory):
+                    os.makedirs(directory, exist_ok=True)
+                    # a new partition is only durable once its parents are synced too
+                    while directory != DIR_NAME:
+                        directory = os.path.dirname(directory)
+                        directories.add(directory)
+                os.rename(path, target)
+                directories.add(os.path.dirname(target))
+                published.append(target)
+            except FileNotFoundError:
+                # listed again before an earlier submit of it was published, already done
+                continue
+            except OSError as e:
+                self.logger.error(f"Failed to finalize {path}: {e}")
+            finally:
+                with self._lock:
+                    self._pending.discard(path)
+
+        for directory in directories:
+            fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+        return published
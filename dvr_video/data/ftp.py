@@ -1,145 +1,262 @@
+import asyncio
 import os
 import pathlib
 import aioftp
 
-from .utils import get_date, find_files_with_extra_after_log, extract_date_from_filename_async, file_date_sort
+from functools import partial
+from typing import NamedTuple
+
+from .utils import get_date, find_files_with_extra_after_log, extract_date_from_filename_async
+from .materials_index import MaterialsIndex
+from .eviction import retention_class
+from .ftp_pool import ThroughputTuner, UploadPool
+from .upload_journal import UploadJournal, STATUS_VERIFIED
+from .upload_shaping import LinkShaper, TokenBucket
+from .constants import DIR_NAME, UPLOAD_PROGRESS_BYTES, UPLOAD_PRIORITY
+
+LOGS_DIR = "/etc/mdvr/logs"
+
+
+UPLOAD_BLOCK_SIZE = 64 * 1024
+
+
+async def store(client: aioftp.Client, source: pathlib.Path, destination: pathlib.PurePosixPath, offset: int = 0,
+                on_progress=None, bucket: TokenBucket | None = None):
+    """
+    Sends source from offset on (REST + STOR when resuming), at the rate of the bucket if given.
+    upload_stream instead of client.upload(), that one checks every parent directory with MLST on each call.
+    on_progress(sent) is called every UPLOAD_PROGRESS_BYTES.
+    """
+    async with client.upload_stream(destination, offset=offset) as stream:
+        with open(source, 'rb') as file_in:
+            file_in.seek(offset)
+            sent, reported = offset, offset
+            while block := file_in.read(UPLOAD_BLOCK_SIZE):
+                if bucket is not None:
+                    await bucket.consume(len(block))
+                await stream.write(block)
+                sent += len(block)
+                if on_progress and sent - reported >= UPLOAD_PROGRESS_BYTES:
+                    on_progress(sent)
+                    reported = sent
+
+
+async def remote_size(client: aioftp.Client, path: pathlib.PurePosixPath) -> int | None:
+    """Size of a remote file, None when there is none. SIZE, or MLST on servers without it."""
+    await client.command("TYPE I", "200")  # SIZE is only defined for binary mode
+    try:
+        _, info = await client.command(f"SIZE {path}", "213")
+        return int(info[-1].split()[-1])
+    except (aioftp.StatusCodeError, ValueError, IndexError):
+        pass
+    try:
+        return int((await client.stat(path))["size"])
+    except (aioftp.StatusCodeError, KeyError, ValueError):
+        return None
+
+
+class UploadVerificationError(Exception):
+    pass
+
+
+class UploadJob(NamedTuple):
+    priority: int
+    name: str
+    source: pathlib.Path
+    directory: pathlib.PurePosixPath  # below the car directory
+    material: bool  # tracked in the materials index
+
+
+class RemoteDirectories:
+    """
+    Remote directories known to exist, filled with one MLSD per parent directory the first time something is
+    uploaded below it and shared by all sessions of a run. Uploads then go straight to absolute paths: no
+    exists/cwd round trips per file, and STOR replaces a file that is already there.
+    """
+
+    def __init__(self, root: pathlib.PurePosixPath):
+        self.root = root
+        self._known = {root}
+        self._listed = {}
+        self._lock = asyncio.Lock()
+
+    async def ensure(self, client: aioftp.Client, directory: pathlib.PurePosixPath, logger=None):
+        if directory in self._known:
+            return
+        async with self._lock:
+            await self._ensure(client, directory, logger)
+
+    async def _ensure(self, client: aioftp.Client, directory: pathlib.PurePosixPath, logger):
+        if directory in self._known:
+            return
+        await self._ensure(client, directory.parent, logger)
+        siblings = await self._list(client, directory.parent)
+        if directory.name not in siblings:
+            if logger:
+                logger.error(f"Directory {directory} does not exist. It will be created.")
+            # plain MKD, make_directory() would check the path with MLST first
+            await client.command(f"MKD {directory}", "257")
+            siblings.add(directory.name)
+            self._listed[directory] = set()  # just created, nothing to list
+        self._known.add(directory)
+
+    async def _list(self, client: aioftp.Client, directory: pathlib.PurePosixPath) -> set[str]:
+        if directory not in self._listed:
+            self._listed[directory] = {path.name for path, info in await client.list(directory)
+                                       if info.get("type") == "dir"}
+        return self._listed[directory]
 
 
 class FTPCon:
-    def __init__(self, host_addr: str, port: int, username: str, password: str, car_name: str):
+    def __init__(self, host_addr: str, port: int, username: str, password: str, car_name: str,
+                 index: MaterialsIndex | None = None, journal: UploadJournal | None = None):
         self.port = port
         self.host = host_addr
         self.username = username
         self.password = password
         self.car_name = car_name
-
-    async def upload_to_ftp(self, logger):
-        async with aioftp.Client.context(self.host, self.port, self.username, self.password, socket_timeout=180) as client:
-            if await client.exists(self.car_name) is False:
-                logger.error(f"Directory {self.car_name} does not exist. It will be created.")
-                await client.make_directory(self.car_name)
-            await client.change_directory(self.car_name)
-
-            try:
-                videos = os.listdir("/etc/mdvr/materials")
-            except FileNotFoundError as e:
-                logger.error(f"Error {e}")
-                pathlib.Path("/etc/mdvr/materials").mkdir(parents=True, exist_ok=True)
-
-            print(videos)
-            videos = file_date_sort(videos)
-            print(videos)
-
-            for video in videos:
-                data = await get_date(video)
-                print(data)
-                if await client.exists(data) is False:
-                    logger.error(f"Directory {data} does not exist. It will be create.")
-                    await client.make_directory(data)
-                await client.change_directory(data)
-
-                if await client.exists(video):
-                    logger.error(f"This file: {video} alredy exists. Remove and upload file.")
-                    await client.remove(video)
-
-                vd = pathlib.Path("/etc/mdvr/materials", video)
-                await client.upload(vd)
-                logger.info(f"The file {video} has been successful upload. Remove from local storage.")
-                os.remove(vd)
-
-                await client.change_directory()
-
-    async def upload_logs_to_ftp(self, logger):
-        async with aioftp.Client.context(self.host, self.port, self.username, self.password, socket_timeout=180) as client:
-            if await client.exists(self.car_name) is False:
-                logger.error(f"Directory {self.car_name} does not exist. It will be create.")
-                await client.make_directory(self.car_name)
-            await client.change_directory(self.car_name)
-
-            try:
-                folders = os.listdir("/etc/mdvr/logs")
-            except FileNotFoundError as e:
-                logger.error(f"Error {e}")
-                pathlib.Path("/etc/mdvr/logs").mkdir(parents=True, exist_ok=True)
-
-            for folder in folders:
-                logs_array = await find_files_with_extra_after_log(os.path.join("/etc/mdvr/logs", folder))
-
-                for log in logs_array:
-                    date_folder = await extract_date_from_filename_async(log)
-
-                    if await client.exists(date_folder) is False:
-                        logger.error(f"Directory {date_folder} does not exist. It will be create.")
-                        await client.make_directory(date_folder)
-                    await client.change_directory(date_folder)
-
-                    if await client.exists("logs") is False:
-                        logger.error("Directory 'logs' does not exist. It will be create.")
-                        await client.make_directory("logs")
-                    await client.change_directory("logs")
-
-                    if await client.exists(folder) is False:
-                        logger.error(f"Directory {folder} does not exist. It will be create.")
-                        await client.make_directory(folder)
-                    await client.change_directory(folder)
-
-                    if await client.exists(log):
-                        logger.error(f"This file: {log} alredy exists. Remove and upload file.")
-                        await client.remove(log)
-
-                    lg = pathlib.Path("/etc/mdvr/logs", folder, log)
-                    print(log)
-
-                    await client.upload(lg)
-                    os.remove(os.path.join("/etc/mdvr/logs", folder, log))
-
-                    pt = pathlib.Path("/", self.car_name)
-
-                    await client.change_directory()
-                    await client.change_directory()
-                    await client.change_directory()
-
-
-    async def upload_start_system_log(self):
-        system_start_log_dir = "mdvr_start"
-        async with aioftp.Client.context(self.host, self.port, self.username, self.password, socket_timeout=180) as client:
-            if await client.exists(self.car_name) is False:
-                await client.make_directory(self.car_name)
-            await client.change_directory(self.car_name)
-
-            try:
-                logs = os.listdir(f"/etc/mdvr/logs/{system_start_log_dir}")
-            except FileNotFoundError as e:
-                pathlib.Path(f"/etc/mdvr/logs/{system_start_log_dir}").mkdir(parents=True, exist_ok=True)
-
-            logs_array = await find_files_with_extra_after_log(os.path.join(f"/etc/mdvr/logs/{system_start_log_dir}"))
-
-            for log in logs_array:
+        self.index = index or MaterialsIndex()
+        self.journal = journal or UploadJournal()
+        self.remote_root = None
+        self.directories = None
+        self.bucket = None
+
+    def session(self):
+        return aioftp.Client.context(self.host, self.port, self.username, self.password, socket_timeout=180)
+
+    async def prepare(self, client: aioftp.Client, logger=None) -> pathlib.PurePosixPath:
+        """Resolves the car directory to an absolute path once, every upload goes below it."""
+        if self.directories is None:
+            home = await client.get_current_directory()
+            self.remote_root = home / self.car_name
+            self.directories = RemoteDirectories(home)
+            await self.directories.ensure(client, self.remote_root, logger)
+        return self.remote_root
+
+    async def material_jobs(self) -> list[UploadJob]:
+        # straight from the index instead of listing the directory
+        jobs = []
+        for row in self.index.pending_uploads():
+            priority = UPLOAD_PRIORITY.index(retention_class(row["kind"], row["event_id"]))
+            jobs.append(UploadJob(priority, row["name"], pathlib.Path(DIR_NAME, row["path"]),
+                                  pathlib.PurePosixPath(await get_date(row["name"])), True))
+        return jobs
+
+    async def log_jobs(self, logger) -> list[UploadJob]:
+        # rotated logs of every service, <car>/<date>/logs/<service>/<log> on the server
+        try:
+            folders = os.listdir(LOGS_DIR)
+        except FileNotFoundError as e:
+            logger.error(f"Error {e}")
+            pathlib.Path(LOGS_DIR).mkdir(parents=True, exist_ok=True)
+            folders = []
+
+        jobs = []
+        priority = UPLOAD_PRIORITY.index('logs')
+        for folder in folders:
+            for log in await find_files_with_extra_after_log(os.path.join(LOGS_DIR, folder)):
                 date_folder = await extract_date_from_filename_async(log)
-
-                if await client.exists(date_folder) is False:
-                    await client.make_directory(date_folder)
-                await client.change_directory(date_folder)
-
-                if await client.exists("logs") is False:
-                    await client.make_directory("logs")
-                await client.change_directory("logs")
-
-                if await client.exists(system_start_log_dir) is False:
-                    await client.make_directory(system_start_log_dir)
-                await client.change_directory(system_start_log_dir)
-
-                if await client.exists(log):
-                    await client.remove(log)
-
-                lg = pathlib.Path(f"/etc/mdvr/logs/{system_start_log_dir}", log)
-                print(log)
-
-                await client.upload(lg)
-                os.remove(os.path.join(f"/etc/mdvr/logs/{system_start_log_dir}", log))
-
-                pt = pathlib.Path("/", self.car_name)
-
-                await client.change_directory()
-                await client.change_directory()
-                await client.change_directory()
+                if date_folder is None:
+                    continue
+                jobs.append(UploadJob(priority, log, pathlib.Path(LOGS_DIR, folder, log),
+                                      pathlib.PurePosixPath(date_folder, "logs", folder), False))
+        return jobs
+
+    def remote_path(self, job: UploadJob) -> pathlib.PurePosixPath:
+        return self.remote_root / job.directory / job.name
+
+    async def jobs(self, logger) -> list[UploadJob]:
+        """Everything waiting for upload, recorded in the journal, without failed files still backing off."""
+        jobs = await self.material_jobs() + await self.log_jobs(logger)
+        self.journal.queue([(str(job.source), str(self.remote_path(job))) for job in jobs])
+        deferred = self.journal.deferred()
+        return [job for job in jobs if str(job.source) not in deferred]
+
+    async def upload_all(self, logger, tuner: ThroughputTuner | None = None, shaper: LinkShaper | None = None):
+        """
+        Event clips, photos, continuous footage and logs, in that order, over the session pool. Materials
+        recorded meanwhile are picked up every FTP_REFILL_INTERVAL seconds and take their place in the queue.
+        """
+        async with self.session() as client:
+            await self.prepare(client, logger)
+
+        try:
+            self.index.reconcile(DIR_NAME)
+        except FileNotFoundError as e:
+            logger.error(f"Error {e}")
+            pathlib.Path(DIR_NAME).mkdir(parents=True, exist_ok=True)
+
+        pruned = self.journal.prune()
+        if pruned:
+            logger.info(f"{pruned} files left the upload journal, they are gone locally.")
+        jobs = await self.jobs(logger)
+        logger.debug(f"{len(jobs)} files queued")
+
+        self.bucket = shaper.bucket if shaper else None
+        monitor = asyncio.create_task(shaper.monitor()) if shaper else None
+        # parallel sessions keep a high latency link busy while each one waits for its round trips
+        pool = UploadPool(self.session, partial(self._upload_job, logger), logger,
+                          tuner or ThroughputTuner.from_config({}),
+                          priority=lambda job: job.priority, refill=partial(self.jobs, logger))
+        try:
+            files, sent = await pool.run(jobs)
+        finally:
+            if monitor:
+                monitor.cancel()
+        logger.info(f"Uploaded {files} files ({sent} bytes), {pool.tuner.size} FTP sessions. "
+                    f"Journal: {self.journal.counts()}.")
+
+    async def _send(self, client: aioftp.Client, source: pathlib.Path, destination: pathlib.PurePosixPath,
+                    logger=None) -> int:
+        """
+        Uploads source, continuing an interrupted upload from the bytes the server already has. Only resumed
+        files cost the extra SIZE round trips, before and after: a fresh STOR is verified by the server
+        confirming the transfer. A file verified before a crash is not sent again. Returns the bytes sent.
+        """
+        local, remote = str(source), str(destination)
+        stat = source.stat()
+        entry = self.journal.get(local, remote, stat)
+        if entry is not None and entry["status"] == STATUS_VERIFIED:
+            return 0
+
+        offset = 0
+        if self.journal.resumable(local, remote, stat) is not None:
+            offset = await remote_size(client, destination) or 0
+            if offset > stat.st_size:
+                offset = 0  # not our partial file
+            elif offset and logger:
+                logger.info(f"Resuming {source.name} at {offset} of {stat.st_size} bytes.")
+
+        if offset < stat.st_size or stat.st_size == 0:
+            self.journal.start(local, remote, stat, offset)
+            await store(client, source, destination, offset, partial(self.journal.progress, local), self.bucket)
+            if offset:
+                received = await remote_size(client, destination)
+                if received != stat.st_size:
+                    raise UploadVerificationError(f"{remote} has {received} of {stat.st_size} bytes")
+        self.journal.verify(local)
+        return stat.st_size - offset
+
+    async def _upload_job(self, logger, client: aioftp.Client, job: UploadJob) -> int:
+        if not job.source.exists():
+            if job.material:
+                logger.error(f"File {job.name} is gone, removing it from the index.")
+                self.index.remove(job.name)
+            return 0
+
+        directory = self.remote_root / job.directory
+        try:
+            await self.directories.ensure(client, directory, logger)
+            sent = await self._send(client, job.source, directory / job.name, logger)
+        except Exception as e:
+            delay = self.journal.fail(str(job.source), str(e) or type(e).__name__)
+            logger.error(f"Upload of {job.name} failed, next try in {delay} s: {e}")
+            raise
+        if job.material:
+            logger.info(f"The file {job.name} has been successful upload. Remove from local storage.")
+            os.remove(job.source)
+            self.index.remove(job.name)
+        else:
+            os.remove(job.source)
+        self.journal.finish(str(job.source))
+        return sent
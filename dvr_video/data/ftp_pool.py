@@ -0,0 +1,175 @@
+import asyncio
+import itertools
+import json
+import os
+import time
+
+from .constants import FTP_TUNING_FILE, FTP_MAX_CONNECTIONS, FTP_TUNE_WINDOW, FTP_REFILL_INTERVAL
+
+
+class ThroughputTuner:
+    """
+    Picks the number of parallel FTP sessions. Every FTP_TUNE_WINDOW seconds of uploading the throughput is
+    compared with the previous window: while it grows by more than `gain` one more session is opened, when it
+    drops the last one is closed again and the size stays. The size that won is saved and the next run starts
+    from it. A fixed size (ftp.connections > 0) is never changed.
+    """
+
+    def __init__(self, size: int, maximum: int = FTP_MAX_CONNECTIONS, auto: bool = True,
+                 window: float = FTP_TUNE_WINDOW, gain: float = 0.1, state_file: str = FTP_TUNING_FILE):
+        self.maximum = maximum
+        self.auto = auto
+        self.window = window
+        self.gain = gain
+        self.state_file = state_file
+        self.size = max(1, min(size, maximum))
+        self.climbing = auto
+        self.previous_rate = None
+        self._bytes = 0
+        self._started = None
+
+    @classmethod
+    def from_config(cls, ftp_config: dict) -> 'ThroughputTuner':
+        maximum = int(ftp_config.get('max_connections', FTP_MAX_CONNECTIONS))
+        connections = int(ftp_config.get('connections', 0))
+        if connections > 0:
+            return cls(connections, max(maximum, connections), auto=False)
+        tuner = cls(1, maximum)
+        tuner.size = max(1, min(tuner.load(), maximum))
+        return tuner
+
+    def load(self) -> int:
+        try:
+            with open(self.state_file, 'r') as f:
+                return int(json.load(f)["connections"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return 1
+
+    def save(self):
+        if not self.auto:
+            return
+        try:
+            tmp_path = f"{self.state_file}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump({"connections": self.size, "bytes_per_second": self.previous_rate}, f)
+            os.replace(tmp_path, self.state_file)
+        except OSError:
+            pass
+
+    def record(self, sent: int) -> int:
+        """Counts an uploaded file, returns the number of sessions to run from now on."""
+        now = time.monotonic()
+        if self._started is None:
+            self._started = now
+        self._bytes += sent
+        elapsed = now - self._started
+        if not self.climbing or elapsed < self.window:
+            return self.size
+
+        rate = self._bytes / elapsed
+        self._bytes, self._started = 0, now
+        if self.previous_rate is not None and rate < self.previous_rate * (1 + self.gain):
+            # the last session did not pay off, the link is saturated
+            if rate < self.previous_rate:
+                self.size -= 1
+            self.climbing = False
+        elif self.size < self.maximum:
+            self.size += 1
+        else:
+            self.climbing = False
+        self.previous_rate = rate
+        return self.size
+
+
+class UploadPool:
+    """
+    Up to tuner.size FTP sessions pulling jobs from one priority queue. `connect` opens a logged-in session
+    (an async context manager), `upload(client, job)` sends one job and returns the bytes sent, it reports its own
+    failures. Sessions above the current size finish their job and close, new ones are opened when the tuner grows.
+
+    Jobs go out by priority(job), lowest first, in queue order within a priority. `refill()`, when given, is
+    awaited every refill_interval seconds for jobs that appeared meanwhile, so a fresh event clip does not wait
+    behind the backlog that was there when the run started. Jobs must be hashable. A job is taken once, a
+    failed one is forgotten and comes back when refill() returns it again.
+    """
+
+    def __init__(self, connect, upload, logger, tuner: ThroughputTuner, priority=None, refill=None,
+                 refill_interval: float = FTP_REFILL_INTERVAL):
+        self.connect = connect
+        self.upload = upload
+        self.logger = logger
+        self.tuner = tuner
+        self.priority = priority or (lambda job: 0)
+        self.refill = refill
+        self.refill_interval = refill_interval
+        self.files = 0
+        self.bytes = 0
+        self._queue = asyncio.PriorityQueue()
+        self._order = itertools.count()
+        self._seen = set()
+        self._refilled = time.monotonic()
+        self._workers = {}
+
+    def put(self, job):
+        if job not in self._seen:
+            self._seen.add(job)
+            self._queue.put_nowait((self.priority(job), next(self._order), job))
+
+    async def _refill(self):
+        if self.refill is None or time.monotonic() - self._refilled < self.refill_interval:
+            return
+        self._refilled = time.monotonic()
+        for job in await self.refill():
+            self.put(job)
+        self._resize()
+
+    async def run(self, jobs: list) -> tuple[int, int]:
+        """Uploads all jobs, returns (files, bytes) sent."""
+        for job in jobs:
+            self.put(job)
+        self._resize()
+        restarted = False
+        while self._workers:
+            await asyncio.wait(list(self._workers.values()), return_when=asyncio.FIRST_COMPLETED)
+            for number, task in list(self._workers.items()):
+                if task.done():
+                    del self._workers[number]
+                    if not task.cancelled() and task.exception() is not None:
+                        self.logger.error(f"FTP session {number} failed: {task.exception()}")
+            if self._workers or self._queue.empty() or restarted:
+                continue
+            # every session dropped, one more try for what is left, the rest waits for the next run
+            restarted = True
+            self._workers[0] = asyncio.create_task(self._worker(0))
+        self.tuner.save()
+        return self.files, self.bytes
+
+    def _resize(self):
+        for number in range(self.tuner.size):
+            if number not in self._workers and not self._queue.empty():
+                self._workers[number] = asyncio.create_task(self._worker(number))
+
+    async def _worker(self, number: int):
+        async with self.connect() as client:
+            while number < self.tuner.size:
+                await self._refill()
+                try:
+                    _, _, job = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                try:
+                    sent = await self.upload(client, job)
+                except (ConnectionError, asyncio.TimeoutError):
+                    # the session is broken, the job comes back with a refill once it may be retried
+                    self._seen.discard(job)
+                    raise
+                except Exception:
+                    # one bad file never stops the others, upload() has reported it
+                    self._seen.discard(job)
+                    continue
+                self.files += 1
+                self.bytes += sent
+                size = self.tuner.size
+                if self.tuner.record(sent) != size:
+                    self.logger.info(f"FTP upload now runs {self.tuner.size} sessions.")
+                    self._resize()
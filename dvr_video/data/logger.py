@@ -41,3 +41,6 @@ class Logger:
 
     def critical(self, message: str):
         self.logger.critical(message)
+
+    def isEnabledFor(self, level: int) -> bool:
+        return self.logger.isEnabledFor(level)
@@ -0,0 +1,347 @@
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+
+from datetime import datetime
+
+from .constants import DIR_NAME, INDEX_FILE, VIDEO_FILE_EXTENSION, PHOTO_FILE_EXTENSION, RETENTION_CONTINUOUS, \
+    RETENTION_EVENT, RETENTION_PHOTO, MATERIALS_RESCAN_INTERVAL
+from .utils import parse_material_name
+
+# the recorder writes mp4 (ts for salvaged events) and jpg, the other containers are listed when copied in by hand
+MATERIAL_KINDS = {VIDEO_FILE_EXTENSION: 'video', '.ts': 'video', '.mkv': 'video', '.avi': 'video', '.mov': 'video',
+                  '.m3u8': 'video', PHOTO_FILE_EXTENSION: 'photo'}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS materials (
+    name TEXT PRIMARY KEY,
+    camera INTEGER,
+    start_ts INTEGER NOT NULL,
+    duration REAL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    event_id TEXT,
+    uploaded INTEGER NOT NULL DEFAULT 0,
+    path TEXT,
+    codec TEXT,
+    width INTEGER,
+    height INTEGER,
+    keyframes TEXT
+);
+CREATE INDEX IF NOT EXISTS materials_start ON materials (start_ts, name);
+CREATE INDEX IF NOT EXISTS materials_upload ON materials (uploaded, start_ts);
+"""
+
+COLUMNS = ('name', 'camera', 'start_ts', 'duration', 'size', 'mtime', 'kind', 'event_id', 'uploaded', 'path',
+           'codec', 'width', 'height', 'keyframes')
+
+# columns added after the first release, with the statement that fills them for existing rows
+MIGRATIONS = (
+    # every file was in the root before the partitioned layout
+    ("path", "TEXT", "UPDATE materials SET path = name"),
+    ("codec", "TEXT", None),
+    ("width", "INTEGER", None),
+    ("height", "INTEGER", None),
+    ("keyframes", "TEXT", None),
+)
+
+MEDIA_COLUMNS = ('duration', 'codec', 'width', 'height', 'keyframes')
+
+
+def media_columns(info: dict | None) -> dict:
+    """mp4info.read_mp4_info() result as index columns, keyframe times are stored as a JSON array."""
+    info = info or {}
+    columns = {column: info.get(column) for column in MEDIA_COLUMNS}
+    if columns["keyframes"] is not None:
+        columns["keyframes"] = json.dumps(columns["keyframes"], separators=(',', ':'))
+    return columns
+
+
+def material_row(path: str, info: dict | None = None, stat: os.stat_result | None = None,
+                 root: str = DIR_NAME) -> dict | None:
+    """
+    Index row for a published file, None for files that are not recordings. path is stored relative to root,
+    info is the parsed media metadata of videos.
+    """
+    name = os.path.basename(path)
+    kind = MATERIAL_KINDS.get(os.path.splitext(name)[1].lower())
+    if kind is None:
+        return None
+
+    stat = stat or os.stat(path)
+    parsed = parse_material_name(name)
+    camera, start, event_id = parsed if parsed else (None, datetime.fromtimestamp(int(stat.st_mtime)), None)
+    return {
+        "name": name,
+        "camera": camera,
+        "start_ts": int(start.timestamp()),
+        "size": stat.st_size,
+        "mtime": int(stat.st_mtime),
+        "kind": kind,
+        "event_id": event_id,
+        "uploaded": 0,
+        "path": os.path.relpath(path, root),
+        **media_columns(info),
+    }
+
+
+def tree_mtimes(directory: str) -> dict[str, int]:
+    """
+    mtime of the directory and of its date/camera partitions, keyed by the path relative to it ('' for itself).
+    A directory's mtime changes whenever a file in it comes or goes.
+    """
+    mtimes = {'': os.stat(directory).st_mtime_ns}
+    level = ['']
+    for _ in range(2):
+        subdirectories = []
+        for parent in level:
+            with os.scandir(os.path.join(directory, parent)) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False) and not entry.name.startswith('.'):
+                        relative = os.path.join(parent, entry.name)
+                        try:
+                            mtimes[relative] = entry.stat().st_mtime_ns
+                        except FileNotFoundError:
+                            continue
+                        subdirectories.append(relative)
+        level = subdirectories
+    return mtimes
+
+
+def estimated_durations(rows: list[sqlite3.Row], max_duration: float) -> list[float]:
+    """
+    Durations of one camera's segments sorted by start. A segment without a parsed duration is assumed to
+    last until the next one starts, at most max_duration.
+    """
+    durations = []
+    for i, row in enumerate(rows):
+        duration = row["duration"]
+        if duration is None:
+            following = rows[i + 1]["start_ts"] if i + 1 < len(rows) else row["start_ts"] + max_duration
+            duration = min(following - row["start_ts"], max_duration)
+        durations.append(duration)
+    return durations
+
+
+class MaterialsIndex:
+    """
+    SQLite index of the materials directory, shared by the recorder, space check, FTP upload and dvr_web.
+
+    The recorder adds every file the finalizer publishes, consumers that delete a file remove its row,
+    so nobody has to list and stat the whole directory. The database runs in WAL mode: readers in other
+    processes never block the recorder. Connections are per thread.
+    """
+
+    def __init__(self, path: str = INDEX_FILE):
+        self.path = path
+        self._local = threading.local()
+        self._scanned = 0  # monotonic time of the last refresh() check
+        self._mtimes = {}  # tree_mtimes() the index was last brought in line with by refresh()
+
+    def _db(self) -> sqlite3.Connection:
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=10)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript(SCHEMA)
+            existing = {row["name"] for row in db.execute("PRAGMA table_info(materials)")}
+            with db:
+                for column, column_type, fill in MIGRATIONS:
+                    if column not in existing:
+                        db.execute(f"ALTER TABLE materials ADD COLUMN {column} {column_type}")
+                        if fill:
+                            db.execute(fill)
+            self._local.db = db
+        return db
+
+    def close(self):
+        db = getattr(self._local, 'db', None)
+        if db is not None:
+            db.close()
+            self._local.db = None
+
+    def _insert(self, rows: list[dict], conflict: str = 'REPLACE'):
+        placeholders = ', '.join(f":{column}" for column in COLUMNS)
+        db = self._db()
+        with db:
+            db.executemany(f"INSERT OR {conflict} INTO materials ({', '.join(COLUMNS)}) VALUES ({placeholders})", rows)
+
+    def add(self, path: str, info: dict | None = None):
+        """SegmentFinalizer subscriber."""
+        try:
+            row = material_row(path, info)
+        except FileNotFoundError:
+            return
+        if row is not None:
+            self._insert([row])
+
+    def remove(self, name: str):
+        db = self._db()
+        with db:
+            db.execute("DELETE FROM materials WHERE name = ?", (name,))
+
+    def set_media(self, media: dict[str, dict | None]):
+        """Caches parsed metadata of files indexed without it (name -> read_mp4_info() result)."""
+        assignments = ', '.join(f"{column} = :{column}" for column in MEDIA_COLUMNS)
+        db = self._db()
+        with db:
+            db.executemany(f"UPDATE materials SET {assignments} WHERE name = :name",
+                           [{"name": name, **media_columns(info)} for name, info in media.items()])
+
+    def keyframes(self, name: str) -> list[float] | None:
+        row = self._db().execute("SELECT keyframes FROM materials WHERE name = ?", (name,)).fetchone()
+        return json.loads(row["keyframes"]) if row and row["keyframes"] else None
+
+    def get(self, name: str) -> sqlite3.Row | None:
+        return self._db().execute("SELECT * FROM materials WHERE name = ?", (name,)).fetchone()
+
+    def count(self) -> int:
+        return self._db().execute("SELECT COUNT(*) FROM materials").fetchone()[0]
+
+    def total_size(self) -> int:
+        return self._db().execute("SELECT COALESCE(SUM(size), 0) FROM materials").fetchone()[0]
+
+    def list_between(self, start: datetime | None = None, end: datetime | None = None,
+                     kind: str | None = None) -> list[sqlite3.Row]:
+        """Materials recorded between start and end (inclusive), oldest first."""
+        query, args = "SELECT * FROM materials WHERE start_ts BETWEEN ? AND ?", [
+            int(start.timestamp()) if start else 0,
+            int(end.timestamp()) if end else 2 ** 62,
+        ]
+        if kind:
+            query += " AND kind = ?"
+            args.append(kind)
+        return self._db().execute(query + " ORDER BY start_ts, name", args).fetchall()
+
+    def covering(self, camera: int, start: datetime, end: datetime, max_duration: float) -> list[sqlite3.Row]:
+        """
+        Video segments of the camera that overlap [start, end), oldest first, see estimated_durations.
+        A segment starting right at end adds nothing to the clip.
+        """
+        rows = self._db().execute(
+            "SELECT * FROM materials WHERE camera = ? AND kind = 'video' AND start_ts >= ? AND start_ts < ? "
+            "ORDER BY start_ts, name",
+            (camera, int(start.timestamp() - max_duration), math.ceil(end.timestamp()))).fetchall()
+        return [row for row, duration in zip(rows, estimated_durations(rows, max_duration))
+                if row["start_ts"] + duration > start.timestamp()]
+
+    def eviction_candidates(self) -> list[tuple]:
+        """(start_ts, path, size, camera, kind, event_id) of every material, one query instead of a directory scan."""
+        return [tuple(row) for row in
+                self._db().execute("SELECT start_ts, path, size, camera, kind, event_id FROM materials")]
+
+    def usage_by_class(self) -> dict[str, int]:
+        """Bytes per retention class, see eviction.retention_class."""
+        rows = self._db().execute(f"""
+            SELECT CASE WHEN kind = 'photo' THEN '{RETENTION_PHOTO}'
+                        WHEN event_id IS NOT NULL THEN '{RETENTION_EVENT}'
+                        ELSE '{RETENTION_CONTINUOUS}' END AS retention, SUM(size)
+            FROM materials GROUP BY retention""")
+        return {name: size for name, size in rows}
+
+    def pending_uploads(self) -> list[sqlite3.Row]:
+        return self._db().execute("SELECT * FROM materials WHERE uploaded = 0 ORDER BY start_ts, name").fetchall()
+
+    def reconcile(self, directory: str = DIR_NAME, force: bool = False) -> int:
+        """
+        Rebuilds the index from one scan of the directory and its date/camera partitions. Without force only
+        an empty index is rebuilt, that covers the first start and a lost database. Returns the number of
+        indexed files.
+        """
+        if not force and self.count():
+            return 0
+
+        db = self._db()
+        # parsed media metadata and upload state survive a rebuild
+        known = {row["name"]: row for row in
+                 db.execute(f"SELECT name, uploaded, {', '.join(MEDIA_COLUMNS)} FROM materials")}
+        rows = []
+        stack = [directory]
+        while stack:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        # date/camera partitions, staging starts with a dot
+                        if not entry.name.startswith('.'):
+                            stack.append(entry.path)
+                        continue
+                    if not entry.is_file(follow_symlinks=False):
+                        continue
+                    try:
+                        row = material_row(entry.path, stat=entry.stat(), root=directory)
+                    except FileNotFoundError:
+                        continue
+                    if row is None:
+                        continue
+                    if row["name"] in known:
+                        previous = known[row["name"]]
+                        row.update({column: previous[column] for column in ('uploaded', *MEDIA_COLUMNS)})
+                    rows.append(row)
+
+        present = {row["name"] for row in rows}
+        with db:
+            db.executemany("DELETE FROM materials WHERE name = ?", [(name,) for name in known if name not in present])
+        self._insert(rows)
+        return len(rows)
+
+    def refresh(self, directory: str = DIR_NAME, interval: float = MATERIALS_RESCAN_INTERVAL) -> int:
+        """
+        Picks up files copied in or deleted by hand (USB pulls, manual cleanup) for readers, at most every
+        `interval` seconds. Only partitions whose mtime changed since the last check of this instance are listed,
+        and only the difference is written: new files are added, missing ones removed, the rows of files that are
+        still there are left alone. A partition the recorder just published into lists the same names as the
+        index and costs no write, so the recorder never waits for a rescan. Returns the number of changed rows.
+        """
+        now = time.monotonic()
+        if self._mtimes and now - self._scanned < interval:
+            return self.reconcile(directory)
+        self._scanned = now
+
+        mtimes = tree_mtimes(directory)
+        changed = {partition for partition in mtimes.keys() | self._mtimes.keys()
+                   if mtimes.get(partition) != self._mtimes.get(partition)}
+        if not changed:
+            return self.reconcile(directory)
+
+        db = self._db()
+        # rows the recorder adds while the partitions are listed are not in known and stay
+        known = {row["name"]: row["path"] for row in db.execute("SELECT name, path FROM materials")}
+        listed = {}
+        added = []
+        for partition in changed & mtimes.keys():
+            try:
+                it = os.scandir(os.path.join(directory, partition))
+            except FileNotFoundError:
+                continue
+            with it:
+                for entry in it:
+                    if not entry.is_file(follow_symlinks=False) or \
+                            os.path.splitext(entry.name)[1].lower() not in MATERIAL_KINDS:
+                        continue
+                    listed[entry.name] = os.path.join(partition, entry.name)
+                    if entry.name in known:
+                        continue
+                    try:
+                        added.append(material_row(entry.path, stat=entry.stat(), root=directory))
+                    except FileNotFoundError:
+                        listed.pop(entry.name)
+
+        removed = [(name,) for name, path in known.items()
+                   if os.path.dirname(path) in changed and name not in listed]
+        moved = [(path, name) for name, path in listed.items() if name in known and known[name] != path]
+        if removed or moved:
+            with db:
+                db.executemany("DELETE FROM materials WHERE name = ?", removed)
+                db.executemany("UPDATE materials SET path = ? WHERE name = ?", moved)
+        if added:
+            # the recorder's own row, with parsed media, wins over the one of the scan
+            self._insert(added, conflict='IGNORE')
+        self._mtimes = mtimes
+        return len(added) + len(removed) + len(moved)
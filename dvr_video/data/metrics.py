@@ -0,0 +1,130 @@
+import json
+import os
+import time
+
+from collections import deque
+
+from .constants import STATS_FILE, STATS_WINDOW
+from .utils import parse_material_name
+
+
+class CameraMetrics:
+    def __init__(self, name: str, target_fps: float | None = None):
+        self.name = name
+        self.target_fps = target_fps
+        self.segments = deque(maxlen=STATS_WINDOW)  # (wall clock close time, size)
+        self.bytes_written = 0
+        self.segments_written = 0
+        self.starts = 0
+        self.failures = 0
+        self.last_exit = None  # monotonic
+        self.last_rc = None
+        self.gap = None  # seconds between the previous process exiting and the next first frame
+        self._gap_pending = False
+        self.running = None  # unknown unless the process lifecycle is reported
+
+    def process_started(self):
+        self.starts += 1
+        self.running = True
+        self._gap_pending = self.last_exit is not None
+
+    def process_exited(self, rc: int | None):
+        self.last_exit = time.monotonic()
+        self.last_rc = rc
+        self.running = False
+        if rc not in (0, 255):
+            self.failures += 1
+
+    def segment_closed(self, size: int):
+        self.segments.append((time.time(), size))
+        self.bytes_written += size
+        self.segments_written += 1
+
+    def bytes_per_second(self) -> float | None:
+        if len(self.segments) < 2:
+            return None
+        span = self.segments[-1][0] - self.segments[0][0]
+        if span <= 0:
+            return None
+        # the first segment only marks the start of the window
+        return sum(size for _, size in list(self.segments)[1:]) / span
+
+    def as_dict(self, progress=None) -> dict:
+        data = {
+            "target_fps": self.target_fps,
+            "bytes_per_second": self.bytes_per_second(),
+            "bytes_written": self.bytes_written,
+            "segments_written": self.segments_written,
+            "starts": self.starts,
+            "failures": self.failures,
+            "last_return_code": self.last_rc,
+            "segment_gap": self.gap,
+            "time_to_first_frame": None,
+            "running": bool(self.running),
+        }
+        if progress is not None:
+            if self._gap_pending and progress.first_frame is not None and progress.first_frame >= self.last_exit:
+                self.gap = round(progress.first_frame - self.last_exit, 3)
+                self._gap_pending = False
+                data["segment_gap"] = self.gap
+            if progress.first_frame is not None:
+                data["time_to_first_frame"] = round(progress.first_frame - progress.started, 3)
+            if self.running is None:
+                data["running"] = not progress.finished
+            data.update(progress.as_dict())
+        return data
+
+
+class MetricsPublisher:
+    """
+    Collects per-camera recording metrics and publishes them as one JSON file.
+    The file is replaced atomically, readers such as dvr_web never see a partial write.
+    """
+
+    def __init__(self, target_fps: float | None = None, path: str = STATS_FILE):
+        self.path = path
+        self.target_fps = target_fps
+        self.cameras: dict[str, CameraMetrics] = {}
+        self.reservation = None  # last SpaceReserver result
+
+    def camera(self, name: str) -> CameraMetrics:
+        if name not in self.cameras:
+            self.cameras[name] = CameraMetrics(name, self.target_fps)
+        return self.cameras[name]
+
+    def rates(self) -> dict[str, float | None]:
+        return {name: camera.bytes_per_second() for name, camera in self.cameras.items()}
+
+    def segment_finalized(self, path: str):
+        """SegmentFinalizer subscriber."""
+        parsed = parse_material_name(path)
+        if parsed is None:
+            return
+        try:
+            self.camera(f"camera_{parsed[0]}").segment_closed(os.path.getsize(path))
+        except OSError:
+            pass
+
+    def publish(self, progress: dict):
+        for name in progress:
+            self.camera(name)
+
+        stats = {
+            "updated": int(time.time()),
+            "cameras": {name: camera.as_dict(progress.get(name)) for name, camera in self.cameras.items()},
+            "reservation": self.reservation,
+        }
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(stats, f)
+        os.replace(tmp_path, self.path)
+
+
+def read_stats(path: str = STATS_FILE) -> dict | None:
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
@@ -0,0 +1,226 @@
+import mmap
+import os
+import struct
+
+# sample_is_non_sync_sample in trun/tfhd/trex sample flags
+NON_SYNC_SAMPLE = 0x10000
+
+
+def iter_boxes(data, start: int, end: int):
+    """Yields (type, payload start, box end) of the boxes between start and end."""
+    offset = start
+    while offset + 8 <= end:
+        size, kind = struct.unpack_from('>I4s', data, offset)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', data, offset + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header or offset + size > end:
+            return  # truncated box, a recording cut short ends here
+        yield kind, offset + header, offset + size
+        offset += size
+
+
+def find_box(data, start: int, end: int, *path: bytes) -> tuple[int, int] | None:
+    for kind, payload, box_end in iter_boxes(data, start, end):
+        if kind == path[0]:
+            return (payload, box_end) if len(path) == 1 else find_box(data, payload, box_end, *path[1:])
+    return None
+
+
+def _full_box(data, offset: int) -> tuple[int, int, int]:
+    """Returns version, flags and the offset after them."""
+    version_flags = struct.unpack_from('>I', data, offset)[0]
+    return version_flags >> 24, version_flags & 0xFFFFFF, offset + 4
+
+
+class _Track:
+    def __init__(self):
+        self.track_id = None
+        self.handler = None
+        self.timescale = None
+        self.duration = 0
+        self.codec = None
+        self.width = None
+        self.height = None
+        self.keyframes = []  # seconds
+        self.default_duration = 0
+        self.default_flags = 0
+
+
+def _parse_trak(data, start: int, end: int) -> _Track:
+    track = _Track()
+    tkhd = find_box(data, start, end, b'tkhd')
+    if tkhd:
+        version, _, offset = _full_box(data, tkhd[0])
+        track.track_id = struct.unpack_from('>I', data, offset + (16 if version == 1 else 8))[0]
+
+    mdhd = find_box(data, start, end, b'mdia', b'mdhd')
+    if mdhd:
+        version, _, offset = _full_box(data, mdhd[0])
+        if version == 1:
+            track.timescale, track.duration = struct.unpack_from('>IQ', data, offset + 16)
+        else:
+            track.timescale, track.duration = struct.unpack_from('>II', data, offset + 8)
+
+    hdlr = find_box(data, start, end, b'mdia', b'hdlr')
+    if hdlr:
+        track.handler = bytes(data[hdlr[0] + 8:hdlr[0] + 12])
+
+    stbl = find_box(data, start, end, b'mdia', b'minf', b'stbl')
+    if stbl is None:
+        return track
+
+    stsd = find_box(data, stbl[0], stbl[1], b'stsd')
+    if stsd:
+        # first sample entry, visual entries carry width and height at a fixed offset
+        entry = stsd[0] + 8
+        track.codec = bytes(data[entry + 4:entry + 8]).decode('ascii', errors='replace')
+        if track.handler == b'vide':
+            track.width, track.height = struct.unpack_from('>HH', data, entry + 32)
+
+    stts = find_box(data, stbl[0], stbl[1], b'stts')
+    stss = find_box(data, stbl[0], stbl[1], b'stss')
+    if stts and track.timescale:
+        # sample number -> decode time, only needed for the sync samples
+        sync = None
+        if stss:
+            _, _, offset = _full_box(data, stss[0])
+            count = struct.unpack_from('>I', data, offset)[0]
+            sync = struct.unpack_from(f'>{count}I', data, offset + 4)
+        _, _, offset = _full_box(data, stts[0])
+        count = struct.unpack_from('>I', data, offset)[0]
+        sample, time, index = 1, 0, 0
+        for i in range(count):
+            sample_count, delta = struct.unpack_from('>II', data, offset + 4 + i * 8)
+            if sync is None:
+                track.keyframes.extend((time + n * delta) / track.timescale for n in range(sample_count))
+            else:
+                while index < len(sync) and sync[index] < sample + sample_count:
+                    track.keyframes.append((time + (sync[index] - sample) * delta) / track.timescale)
+                    index += 1
+            sample += sample_count
+            time += sample_count * delta
+        track.duration = track.duration or time
+    return track
+
+
+def _parse_traf(data, start: int, end: int, tracks: dict[int, _Track]):
+    tfhd = find_box(data, start, end, b'tfhd')
+    if tfhd is None:
+        return
+    _, flags, offset = _full_box(data, tfhd[0])
+    track = tracks.get(struct.unpack_from('>I', data, offset)[0])
+    if track is None or not track.timescale:
+        return
+    offset += 4
+    if flags & 0x1:
+        offset += 8  # base data offset
+    if flags & 0x2:
+        offset += 4  # sample description index
+    default_duration = track.default_duration
+    if flags & 0x8:
+        default_duration = struct.unpack_from('>I', data, offset)[0]
+        offset += 4
+    if flags & 0x10:
+        offset += 4  # default sample size
+    default_flags = track.default_flags
+    if flags & 0x20:
+        default_flags = struct.unpack_from('>I', data, offset)[0]
+
+    base = None
+    tfdt = find_box(data, start, end, b'tfdt')
+    if tfdt:
+        version, _, offset = _full_box(data, tfdt[0])
+        base = struct.unpack_from('>Q' if version == 1 else '>I', data, offset)[0]
+    time = track.duration if base is None else base
+
+    for kind, payload, _ in iter_boxes(data, start, end):
+        if kind != b'trun':
+            continue
+        _, flags, offset = _full_box(data, payload)
+        sample_count = struct.unpack_from('>I', data, offset)[0]
+        offset += 4
+        if flags & 0x1:
+            offset += 4  # data offset
+        first_flags = None
+        if flags & 0x4:
+            first_flags = struct.unpack_from('>I', data, offset)[0]
+            offset += 4
+        fields = [bit for bit in (0x100, 0x200, 0x400, 0x800) if flags & bit]
+        for n in range(sample_count):
+            duration, sample_flags = default_duration, default_flags
+            for bit in fields:
+                value = struct.unpack_from('>I', data, offset)[0]
+                offset += 4
+                if bit == 0x100:
+                    duration = value
+                elif bit == 0x400:
+                    sample_flags = value
+            if n == 0 and first_flags is not None:
+                sample_flags = first_flags
+            if track.handler == b'vide' and not sample_flags & NON_SYNC_SAMPLE:
+                track.keyframes.append(time / track.timescale)
+            time += duration
+    track.duration = time
+
+
+def read_mp4_info(path: str) -> dict | None:
+    """
+    Duration, video codec, resolution and keyframe times (seconds) of an mp4, read from its boxes.
+    Works for regular and fragmented files (moov + moof/traf), including ones cut short by a crash.
+    Only box headers and the sample tables are touched, mdat pages are never read.
+    Returns None for files that are not mp4 or have no video track.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < 8:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            try:
+                return _read(data)
+            except struct.error:
+                return None  # box shorter than its fields
+
+
+def _read(data) -> dict | None:
+    tracks, movie_duration = {}, None
+    for kind, payload, box_end in iter_boxes(data, 0, len(data)):
+        if kind == b'moov':
+            mvhd = find_box(data, payload, box_end, b'mvhd')
+            if mvhd:
+                version, _, offset = _full_box(data, mvhd[0])
+                if version == 1:
+                    timescale, duration = struct.unpack_from('>IQ', data, offset + 16)
+                else:
+                    timescale, duration = struct.unpack_from('>II', data, offset + 8)
+                movie_duration = duration / timescale if timescale and duration else None
+            for child, child_payload, child_end in iter_boxes(data, payload, box_end):
+                if child == b'trak':
+                    track = _parse_trak(data, child_payload, child_end)
+                    tracks[track.track_id] = track
+                elif child == b'mvex':
+                    for trex, trex_payload, _ in iter_boxes(data, child_payload, child_end):
+                        if trex == b'trex':
+                            _, _, offset = _full_box(data, trex_payload)
+                            track_id, _, duration, _, flags = struct.unpack_from('>5I', data, offset)
+                            if track_id in tracks:
+                                tracks[track_id].default_duration = duration
+                                tracks[track_id].default_flags = flags
+        elif kind == b'moof':
+            for child, child_payload, child_end in iter_boxes(data, payload, box_end):
+                if child == b'traf':
+                    _parse_traf(data, child_payload, child_end, tracks)
+
+    video = next((track for track in tracks.values() if track.handler == b'vide'), None)
+    if video is None:
+        return None
+    duration = video.duration / video.timescale if video.timescale and video.duration else movie_duration
+    return {
+        "duration": round(duration, 3) if duration else None,
+        "codec": video.codec,
+        "width": video.width,
+        "height": video.height,
+        "keyframes": [round(t, 3) for t in video.keyframes],
+    }
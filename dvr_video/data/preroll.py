@@ -0,0 +1,272 @@
+import itertools
+import math
+import os
+import queue
+import shutil
+import threading
+import time
+
+from datetime import datetime
+
+import ffmpeg
+
+from .constants import PREROLL_DIR, PREROLL_SPILL_DIR, LEGACY_PREROLL_SPILL_DIR, PREROLL_SEGMENT_SECONDS, \
+    CAMERA_RESTART_DELAY, DATE_FORMAT, VIDEO_FILE_EXTENSION
+from .utils import generate_file_output_name, stop_ffmpeg
+
+
+class PrerollRing:
+    """
+    Keeps the last `seconds` of one camera as short MPEG-TS segments on tmpfs.
+
+    ffmpeg writes numbered segments continuously; while idle only the newest ones covering
+    `seconds` (and at most `max_bytes`) are kept. During an event nothing is dropped, closed
+    segments are spilled to disk instead so RAM use stays bounded. Every `part_seconds` of the
+    event (and at end_event()) the spilled segments are concatenated with stream copy into one
+    mp4 tagged with the event id. When that fails the segments are appended into one .ts instead,
+    and if even that fails they are kept in a directory of the spill dir; they are never dropped.
+    Parts are written by a worker thread of the ring, so poll() never waits for ffmpeg; they show up
+    in take_parts() once written.
+    """
+
+    def __init__(self, current_link: int, spawn, logger, seconds: int, max_bytes: int, part_seconds: int,
+                 output_options: dict | None = None, segment_seconds: int = PREROLL_SEGMENT_SECONDS):
+        """
+        :param spawn: Callable(pattern) that starts the segmenting ffmpeg and returns the process.
+        :param part_seconds: Maximum length of one event file.
+        :param output_options: Extra ffmpeg options for the event mp4, e.g. movflags.
+        """
+        self.current_link = current_link
+        self.spawn = spawn
+        self.logger = logger
+        self.seconds = seconds
+        self.max_bytes = max_bytes
+        self.part_seconds = part_seconds
+        self.output_options = output_options or {}
+        self.segment_seconds = segment_seconds
+        self.ring_dir = os.path.join(PREROLL_DIR, f"camera_{current_link + 1}")
+        self.spill_dir = os.path.join(PREROLL_SPILL_DIR, f"camera_{current_link + 1}")
+        self.proc = None
+        self.next_start = 0
+        self.segments = {}  # name -> wall clock start
+        self.event = None  # [(path, start)] while recording an event
+        self.event_id = None
+        self.parts = []  # finished event files not yet taken by the caller
+        self._spilled = itertools.count()  # spill names stay unique when ffmpeg restarts its numbering
+        self._writes = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        shutil.rmtree(self.ring_dir, ignore_errors=True)
+        os.makedirs(self.ring_dir, exist_ok=True)
+        os.makedirs(self.spill_dir, exist_ok=True)
+        if self._thread is None:
+            self._recover()
+            self._thread = threading.Thread(target=self._run, name=f'preroll-{self.current_link + 1}', daemon=True)
+            self._thread.start()
+        self.segments.clear()
+        self._spawn()
+
+    def _spawn(self):
+        try:
+            self.proc = self.spawn(os.path.join(self.ring_dir, "%08d.ts"))
+        except Exception as e:
+            self.logger.error(f"Failed to initialize pre-roll of camera {self.current_link + 1}: {e}")
+            self.proc = None
+            self.next_start = time.monotonic() + CAMERA_RESTART_DELAY
+
+    def _recover(self):
+        """
+        Queues segments of an event cut short by a crash (loose files of the spill dir, also of the old relative
+        one) as parts of their own, tagged with the time of their first segment. Directories of the spill dir
+        hold events that failed to write and are left alone.
+        """
+        legacy = os.path.join(LEGACY_PREROLL_SPILL_DIR, f"camera_{self.current_link + 1}")
+        if os.path.isdir(legacy):
+            for name in os.listdir(legacy):
+                shutil.move(os.path.join(legacy, name), os.path.join(self.spill_dir, name))
+            os.rmdir(legacy)
+
+        segments = []
+        for entry in os.scandir(self.spill_dir):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith('.ts'):
+                segments.append((entry.stat().st_mtime, entry.path))
+            else:
+                os.remove(entry.path)  # concat list of an interrupted write
+        if not segments:
+            return
+
+        self.logger.warning(f"Recovering {len(segments)} event segments of camera {self.current_link + 1}.")
+        numbers = [int(os.path.basename(path)[:-3]) for _, path in segments if os.path.basename(path)[:-3].isdigit()]
+        self._spilled = itertools.count(max(numbers, default=-1) + 1)
+        event = [(path, mtime - self.segment_seconds) for mtime, path in sorted(segments)]
+        per_part = max(1, self.part_seconds // self.segment_seconds)
+        for i in range(0, len(event), per_part):
+            part = event[i:i + per_part]
+            self._writes.put((part, datetime.fromtimestamp(event[0][1]).strftime(DATE_FORMAT)))
+
+    def stop(self):
+        if self.proc is not None:
+            stop_ffmpeg(self.proc, self.logger, timeout=5)
+            self.proc = None
+
+    def poll(self):
+        if self.proc is None or self.proc.poll() is not None:
+            if self.proc is not None:
+                self.logger.error(f"Pre-roll of camera {self.current_link + 1} exited. "
+                                  f"Return code: {self.proc.returncode}")
+                self.proc = None
+                self.next_start = time.monotonic() + CAMERA_RESTART_DELAY
+            if self.event is not None:
+                # ffmpeg closed its segments when it exited, they belong to the event
+                self._spill(sorted(os.listdir(self.ring_dir)))
+            if time.monotonic() >= self.next_start:
+                if self.event is None:
+                    self.start()
+                else:
+                    self._spawn()  # the ring is empty, the event goes on in the spill dir
+            return
+
+        now = time.time()
+        names = sorted(os.listdir(self.ring_dir))
+        for name in names:
+            self.segments.setdefault(name, now)
+
+        closed = names[:-1]  # the newest segment is still written by ffmpeg
+        if self.event is not None:
+            self._spill(closed)
+        else:
+            self._prune(closed)
+
+    def begin_event(self, event_id: str):
+        self.poll()
+        self.event = []
+        self.event_id = event_id
+
+    def take_parts(self) -> list[str]:
+        with self._lock:
+            parts, self.parts = self.parts, []
+        return parts
+
+    def end_event(self) -> list[str]:
+        """
+        Waits for the open segment to close, then hands the rest of the event to the writer.
+        Returns the parts written so far, the last ones come from take_parts() later.
+        """
+        if self.event is None:
+            return self.take_parts()
+
+        deadline = time.monotonic() + self.segment_seconds * 2
+        last = max(self.segments, default=None)
+        while self.proc is not None and time.monotonic() < deadline:
+            self.poll()
+            if max(self.segments, default=None) != last:
+                break
+            time.sleep(0.1)
+        self.poll()
+
+        if self.proc is None:
+            # ffmpeg is gone, whatever is left in the ring is final
+            self._spill(sorted(os.listdir(self.ring_dir)))
+        self._write_part()
+        self.event = None
+        self.event_id = None
+        return self.take_parts()
+
+    def _write_part(self):
+        event, self.event = self.event, []
+        if event:
+            self._writes.put((event, self.event_id))
+
+    def _run(self):
+        while True:
+            event, event_id = self._writes.get()
+            try:
+                self._write(event, event_id)
+            except Exception as e:
+                self.logger.error(f"Failed to write event of camera {self.current_link + 1}: {e}")
+            finally:
+                self._writes.task_done()
+
+    def _write(self, event: list[tuple[str, float]], event_id: str):
+        start = datetime.fromtimestamp(event[0][1]).strftime(DATE_FORMAT)
+        output = generate_file_output_name(self.current_link, start, VIDEO_FILE_EXTENSION, event_id)
+        paths = [path for path, _ in event]
+        part = output if self._concat(paths, output) else self._salvage(paths, output)
+        if part is None:
+            # the segments are all that is left of this part, they stay until someone takes them
+            kept = os.path.join(self.spill_dir, os.path.splitext(os.path.basename(output))[0])
+            os.makedirs(kept, exist_ok=True)
+            for path in paths:
+                os.rename(path, os.path.join(kept, os.path.basename(path)))
+            self.logger.error(f"Event segments of camera {self.current_link + 1} kept in {kept}.")
+            return
+
+        for path in paths:
+            os.remove(path)
+        with self._lock:
+            self.parts.append(part)
+
+    def _concat(self, paths: list[str], output: str) -> bool:
+        list_path = os.path.join(self.spill_dir, f"{os.path.basename(output)}.txt")
+        try:
+            with open(list_path, 'w') as f:
+                for path in paths:
+                    f.write(f"file '{os.path.abspath(path)}'\n")
+            ffmpeg.input(list_path, f='concat', safe=0).output(output, c='copy', **self.output_options).run(quiet=True)
+            return True
+        except ffmpeg.Error as e:
+            self.logger.error(f"Failed to write event of camera {self.current_link + 1}: {e.stderr}")
+        except OSError as e:
+            # no ffmpeg binary, or no room for the list
+            self.logger.error(f"Failed to write event of camera {self.current_link + 1}: {e}")
+        finally:
+            if os.path.exists(list_path):
+                os.remove(list_path)
+
+        if os.path.exists(output):
+            os.remove(output)
+        return False
+
+    def _salvage(self, paths: list[str], output: str) -> str | None:
+        """MPEG-TS segments play back when simply appended, the event is kept as one .ts without the mp4."""
+        target = f"{os.path.splitext(output)[0]}.ts"
+        try:
+            with open(target, 'wb') as f_out:
+                for path in paths:
+                    with open(path, 'rb') as f_in:
+                        shutil.copyfileobj(f_in, f_out)
+        except OSError as e:
+            self.logger.error(f"Failed to save event of camera {self.current_link + 1} as {target}: {e}")
+            if os.path.exists(target):
+                os.remove(target)
+            return None
+        self.logger.warning(f"Event of camera {self.current_link + 1} saved as MPEG-TS: {target}")
+        return target
+
+    def _spill(self, names: list[str]):
+        for name in names:
+            src = os.path.join(self.ring_dir, name)
+            dst = os.path.join(self.spill_dir, f"{next(self._spilled):08d}.ts")
+            shutil.move(src, dst)
+            self.event.append((dst, self.segments.pop(name, time.time())))
+            if len(self.event) * self.segment_seconds >= self.part_seconds:
+                self._write_part()
+
+    def _prune(self, closed: list[str]):
+        keep = math.ceil(self.seconds / self.segment_seconds)
+        drop = closed[:-keep] if keep else closed
+        kept = closed[len(drop):]
+
+        total = sum(os.path.getsize(os.path.join(self.ring_dir, name)) for name in kept)
+        while kept and total > self.max_bytes:
+            name = kept.pop(0)
+            total -= os.path.getsize(os.path.join(self.ring_dir, name))
+            drop.append(name)
+
+        for name in drop:
+            os.remove(os.path.join(self.ring_dir, name))
+            self.segments.pop(name, None)
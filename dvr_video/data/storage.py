@@ -0,0 +1,210 @@
+import os
+import sqlite3
+import threading
+import time
+
+import psutil
+
+from .constants import DIR_NAME, TEMP_DIR, PREROLL_SPILL_DIR, PROGRAM_OPTIONS_KEY, RESERVE_MARGIN
+from .eviction import evict, scan_candidates, RetentionPolicy
+from .materials_index import MaterialsIndex
+
+
+class StorageBudget:
+    """size_folder_limit_gb is the high watermark, eviction frees down to space_low_watermark_percent of it."""
+
+    def __init__(self, config: dict):
+        options = config[PROGRAM_OPTIONS_KEY]
+        self.high = int(float(options['size_folder_limit_gb']) * 1_000_000_000)
+        self.low = self.high * int(options.get('space_low_watermark_percent', 90)) // 100
+        self.min_free = int(options.get('min_free_mb', 512)) * 1024 * 1024
+
+    def headroom(self, used: int, free: int) -> int:
+        """Bytes that can still be written before either limit is hit."""
+        return min(self.high - used, free - self.min_free)
+
+
+def staging_usage() -> int:
+    # files the recorder is still writing, a handful per camera, and event segments spilled from the pre-roll
+    total = 0
+    stack = [TEMP_DIR, PREROLL_SPILL_DIR]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except FileNotFoundError:
+            continue
+        with it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file():
+                        total += entry.stat().st_size
+                except FileNotFoundError:
+                    continue
+    return total
+
+
+def free_space(path: str = DIR_NAME) -> int:
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+
+def materials_usage(index: MaterialsIndex) -> int:
+    try:
+        index.reconcile()
+        return index.total_size()
+    except sqlite3.Error:
+        return scan_candidates(DIR_NAME, skip=TEMP_DIR)[1]
+
+
+def load_candidates(index: MaterialsIndex, logger) -> tuple[list[tuple], int, bool]:
+    """Returns eviction candidates, the bytes in use and whether the candidates come from the index."""
+    try:
+        index.reconcile()
+        candidates = [(start_ts, os.path.join(DIR_NAME, path), *rest)
+                      for start_ts, path, *rest in index.eviction_candidates()]
+        return candidates, sum(candidate[2] for candidate in candidates), True
+    except sqlite3.Error as e:
+        logger.error(f"Materials index unavailable, scanning {DIR_NAME}: {e}")
+        candidates, total = scan_candidates(DIR_NAME, skip=TEMP_DIR)
+        return candidates, total, False
+
+
+def remove_empty_partitions(directory: str = DIR_NAME):
+    """
+    Drops yymmdd/camN directories emptied by eviction. Every day is looked at: retention classes keep events
+    of a day while newer continuous footage goes, so emptied days can follow a kept one.
+    """
+    try:
+        days = [name for name in os.listdir(directory) if name.isdigit()]
+    except FileNotFoundError:
+        return
+    for day in days:
+        day_path = os.path.join(directory, day)
+        if not os.path.isdir(day_path):
+            continue
+        for camera in os.listdir(day_path):
+            try:
+                os.rmdir(os.path.join(day_path, camera))
+            except OSError:
+                pass  # still has files
+        try:
+            os.rmdir(day_path)
+        except OSError:
+            pass  # still has files
+
+
+def set_idle_priority(logger, pid: int | None = None):
+    """Lowest CPU and I/O priority for the process, or one of its threads on Linux (pid is then the thread id)."""
+    # eviction must never compete with the recorder for the card
+    try:
+        process = psutil.Process(pid)
+        process.ionice(psutil.IOPRIO_CLASS_IDLE)
+        process.nice(19)
+    except (AttributeError, psutil.Error, OSError) as e:
+        logger.warning(f"Failed to lower I/O priority: {e}")
+
+
+def round_bytes(rates: dict[str, float | None], cameras: list[str], seconds: float) -> int:
+    """Bytes the cameras write in the next `seconds`. A camera without a rate yet counts as the average one."""
+    known = [rates[name] for name in cameras if rates.get(name)]
+    if not known:
+        return 0
+    average = sum(known) / len(known)
+    return int(sum(rates.get(name) or average for name in cameras) * seconds)
+
+
+def forecast(rates: dict[str, float | None], used: int, free: int, budget: StorageBudget) -> dict:
+    rate = sum(value for value in rates.values() if value)
+    headroom = budget.headroom(used, free)
+    return {
+        "used": used,
+        "free": free,
+        "limit": budget.high,
+        "low_watermark": budget.low,
+        "min_free": budget.min_free,
+        "headroom": headroom,
+        "bytes_per_second": rate,
+        "cameras": rates,
+        # time until the guard has to start evicting at the current write rate
+        "seconds_to_full": max(headroom, 0) / rate if rate else None,
+        "bytes_per_day": int(rate * 86400),
+    }
+
+
+class SpaceReserver:
+    """
+    Frees room for the next round of segments before ffmpeg needs it, instead of waiting for the space guard
+    to react to a full card. Only the deficit is evicted, in retention order.
+    """
+
+    def __init__(self, index: MaterialsIndex, logger, margin: float = RESERVE_MARGIN):
+        self.index = index
+        self.logger = logger
+        self.margin = margin
+        self.last = None
+
+    def reserve(self, needed: int, config: dict) -> dict:
+        needed = int(needed * self.margin)
+        used = materials_usage(self.index) + staging_usage()
+        deficit = needed - StorageBudget(config).headroom(used, free_space())
+        reservation = {"updated": int(time.time()), "needed": needed, "deficit": max(deficit, 0),
+                       "files": 0, "bytes": 0}
+
+        if deficit > 0:
+            candidates, _, indexed = load_candidates(self.index, self.logger)
+            on_removed = (lambda path: self.index.remove(os.path.basename(path))) if indexed else None
+            report = evict(candidates, deficit, 0, self.logger, RetentionPolicy(config.get('retention')), on_removed)
+            self.logger.info(f"Reserved {needed} bytes for the next segments: {report}.")
+            reservation.update(files=report.files, bytes=report.bytes)
+            remove_empty_partitions()
+
+        self.last = reservation
+        return reservation
+
+    def reserve_round(self, rates: dict[str, float | None], cameras: list[str], seconds: float,
+                      config: dict) -> dict | None:
+        """Reserves the next `seconds` of all cameras, at most twice per round. Returns None when skipped."""
+        if self.last is not None and time.time() - self.last["updated"] < seconds / 2:
+            return None
+        return self.reserve(round_bytes(rates, cameras, seconds), config)
+
+
+class ReservationWorker:
+    """
+    Runs reserve(force) on a thread of its own at idle priority, like the space guard, so eviction never
+    delays an event recording or the finalizer. Requests made while a reservation runs collapse into one,
+    a forced request wins over a regular one.
+    """
+
+    def __init__(self, reserve, logger):
+        self.reserve = reserve
+        self.logger = logger
+        self._force = None  # None while nothing is requested
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='space-reserver', daemon=True)
+        self._thread.start()
+
+    def request(self, force: bool = False):
+        with self._lock:
+            self._force = bool(self._force) or force
+        self._wake.set()
+
+    def _run(self):
+        set_idle_priority(self.logger, threading.get_native_id())
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            with self._lock:
+                force, self._force = self._force, None
+            if force is None:
+                continue
+            try:
+                self.reserve(force)
+            except Exception as e:
+                self.logger.error(f"Failed to reserve space: {e}")
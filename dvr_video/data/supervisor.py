@@ -0,0 +1,229 @@
+import asyncio
+import signal
+import time
+
+from .constants import WATCH_DOG_NOTIFICATION, CAMERA_RESTART_DELAY, CAMERA_BACKOFF_MAX, SEGMENT_POLL_INTERVAL, \
+    WATCHDOG_INTERVAL, STATS_INTERVAL, CAMERA_STALL_GRACE
+from .ffmpeg_monitor import FfmpegMonitor, with_progress
+from .metrics import MetricsPublisher
+
+
+class CameraJob:
+    def __init__(self, name: str, command, on_exit=None, on_tick=None, restart_delay: float = 0,
+                 max_runtime: float | None = None, min_uptime: float = 10, stall_timeout: float = CAMERA_STALL_GRACE):
+        """
+        :param name: Camera name used in logs.
+        :param command: Callable without arguments, returns the ffmpeg argument list for a new run.
+        :param on_exit: Called with the return code after the process has exited (in a worker thread).
+        :param on_tick: Called every SEGMENT_POLL_INTERVAL seconds while the process runs (in a worker thread).
+        :param restart_delay: Pause before the next run after a successful one.
+        :param max_runtime: A process running longer than this is considered stalled and stopped.
+        :param min_uptime: A process exiting sooner than this is considered failed.
+        :param stall_timeout: A process whose -progress output shows no new frames for this long is stopped.
+        """
+        self.name = name
+        self.command = command
+        self.on_exit = on_exit
+        self.on_tick = on_tick
+        self.restart_delay = restart_delay
+        self.max_runtime = max_runtime
+        self.min_uptime = min_uptime
+        self.stall_timeout = stall_timeout
+        self.proc = None
+        self.failures = 0
+
+
+class CameraSupervisor:
+    """
+    Owns one asyncio task per camera. Every task starts, watches and restarts its own ffmpeg process,
+    so a camera that stalls or keeps failing only delays itself. A process that stops writing frames is
+    restarted after its stall_timeout, and the systemd watchdog is only fed while every running process
+    writes frames, so a job the supervisor fails to restart gets the whole service restarted.
+    """
+
+    def __init__(self, logger, notifier=None, backoff_base: float = CAMERA_RESTART_DELAY,
+                 backoff_max: float = CAMERA_BACKOFF_MAX, monitor: FfmpegMonitor | None = None,
+                 metrics: MetricsPublisher | None = None):
+        self.logger = logger
+        self.monitor = monitor or FfmpegMonitor(logger)
+        self.metrics = metrics
+        self.notifier = notifier
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.jobs: list[CameraJob] = []
+        self._stopping = None
+
+    def add(self, job: CameraJob) -> CameraJob:
+        self.jobs.append(job)
+        return job
+
+    def stop(self):
+        if self._stopping is not None:
+            self._stopping.set()
+
+    async def run(self):
+        self._stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop)
+
+        tasks = [asyncio.create_task(self._run_job(job)) for job in self.jobs]
+        background = [asyncio.create_task(self._heartbeat())]
+        if self.metrics is not None:
+            background.append(asyncio.create_task(self._publish_metrics()))
+
+        await asyncio.gather(*tasks)
+        for task in background:
+            task.cancel()
+
+    def _stalled(self, job: CameraJob) -> float | None:
+        """Seconds the running process of the job has not written frames, None between runs."""
+        progress = self.monitor.progress.get(job.name)
+        if job.proc is None or progress is None:
+            return None  # starting or waiting for a restart, both are bounded
+        return progress.stalled_for()
+
+    def _healthy(self) -> bool:
+        # a stalled process is stopped after stall_timeout, twice that means stopping it did not work
+        for job in self.jobs:
+            stalled = self._stalled(job)
+            if stalled is not None and stalled > job.stall_timeout * 2:
+                return False
+        return True
+
+    async def _heartbeat(self):
+        while True:
+            if self.notifier is not None:
+                if self._healthy():
+                    self.notifier.notify(WATCH_DOG_NOTIFICATION)
+                else:
+                    self.logger.error("Camera jobs stalled, withholding the watchdog notification.")
+            await asyncio.sleep(WATCHDOG_INTERVAL)
+
+    async def _publish_metrics(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.metrics.publish, dict(self.monitor.progress))
+            except Exception as e:
+                self.logger.error(f"Failed to publish metrics: {e}")
+            await asyncio.sleep(STATS_INTERVAL)
+
+    async def _sleep(self, delay: float) -> bool:
+        """Sleeps unless the supervisor is stopped. Returns True if it is stopping."""
+        try:
+            await asyncio.wait_for(self._stopping.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+        return self._stopping.is_set()
+
+    async def _run_job(self, job: CameraJob):
+        while not self._stopping.is_set():
+            started = time.monotonic()
+            rc = None
+            try:
+                # commands may probe the camera, keep that off the event loop
+                command = await asyncio.to_thread(job.command)
+                job.proc = await asyncio.create_subprocess_exec(*with_progress(command),
+                                                                stdin=asyncio.subprocess.DEVNULL,
+                                                                stdout=asyncio.subprocess.PIPE,
+                                                                stderr=asyncio.subprocess.PIPE)
+            except Exception as e:
+                self.logger.error(f"Failed to initialize camera {job.name}: {e}")
+            else:
+                if self.metrics is not None:
+                    self.metrics.camera(job.name).process_started()
+                rc = await self._watch(job)
+                if self.metrics is not None:
+                    self.metrics.camera(job.name).process_exited(rc)
+            finally:
+                job.proc = None
+
+            if job.on_exit is not None:
+                try:
+                    await asyncio.to_thread(job.on_exit, rc)
+                except Exception as e:
+                    self.logger.error(f"Camera {job.name} exit handler failed: {e}")
+
+            if self._stopping.is_set():
+                break
+
+            if rc in (0, 255) and time.monotonic() - started >= job.min_uptime:
+                job.failures = 0
+                delay = job.restart_delay
+            else:
+                job.failures += 1
+                delay = min(self.backoff_max, self.backoff_base * 2 ** (job.failures - 1))
+                self.logger.error(f"Camera {job.name} unavailable. Return code: {rc}. "
+                                  f"Restart in {delay}s (failure {job.failures}).")
+
+            if delay and await self._sleep(delay):
+                break
+
+    async def _watch(self, job: CameraJob) -> int | None:
+        proc = job.proc
+        reader = asyncio.create_task(self.monitor.watch(job.name, proc))
+        exited = asyncio.create_task(proc.wait())
+        stopping = asyncio.create_task(self._stopping.wait())
+        deadline = time.monotonic() + job.max_runtime if job.max_runtime else None
+
+        while not exited.done():
+            await asyncio.wait({exited, stopping}, timeout=SEGMENT_POLL_INTERVAL,
+                               return_when=asyncio.FIRST_COMPLETED)
+            if exited.done():
+                break
+
+            if stopping.done():
+                await stop_process(proc, self.logger)
+                break
+
+            if deadline is not None and time.monotonic() > deadline:
+                self.logger.error(f"Camera {job.name} stalled, stopping ffmpeg.")
+                await stop_process(proc, self.logger)
+                break
+
+            stalled = self._stalled(job)
+            if stalled is not None and stalled > job.stall_timeout:
+                self.logger.error(f"Camera {job.name} wrote no frames for {stalled:.0f}s, stopping ffmpeg.")
+                await stop_process(proc, self.logger)
+                break
+
+            if job.on_tick is not None:
+                try:
+                    await asyncio.to_thread(job.on_tick)
+                except Exception as e:
+                    self.logger.error(f"Camera {job.name} tick handler failed: {e}")
+
+        stopping.cancel()
+        await exited
+        await reader
+        return proc.returncode
+
+
+async def stop_process(proc, logger, timeout: float = 5.0):
+    """
+    Asyncio counterpart of utils.stop_ffmpeg: SIGINT -> wait(timeout) -> SIGTERM -> wait -> SIGKILL.
+    """
+    if proc.returncode is not None:
+        return proc.returncode
+
+    try:
+        proc.send_signal(signal.SIGINT)
+        return await asyncio.wait_for(proc.wait(), timeout)
+    except ProcessLookupError:
+        return await proc.wait()
+    except asyncio.TimeoutError:
+        logger.warning("ffmpeg did not respond to SIGINT, sending SIGTERM.")
+
+    try:
+        proc.terminate()
+        return await asyncio.wait_for(proc.wait(), timeout)
+    except ProcessLookupError:
+        return await proc.wait()
+    except asyncio.TimeoutError:
+        logger.warning("ffmpeg did not terminate, sending SIGKILL.")
+
+    try:
+        proc.kill()
+    except ProcessLookupError:
+        pass
+    return await proc.wait()
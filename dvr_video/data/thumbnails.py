@@ -0,0 +1,148 @@
+import os
+import queue
+import subprocess
+import threading
+
+from .constants import THUMBNAIL_DIR, THUMBNAIL_CACHE_MB, THUMBNAIL_WIDTH, SPRITE_TILES, VIDEO_FILE_EXTENSION
+from .utils import parse_material_name
+
+# ffmpeg at the lowest CPU and I/O priority, decoding keyframes only
+LOW_PRIORITY = ['nice', '-n', '19', 'ionice', '-c', '3']
+PREVIEW_KINDS = ('poster', 'sprite')
+
+
+def poster_command(source: str, target: str) -> list[str]:
+    return [*LOW_PRIORITY, 'ffmpeg', '-hide_banner', '-loglevel', 'error', '-y',
+            '-skip_frame', 'nokey', '-i', source,
+            '-frames:v', '1', '-vf', f"scale={THUMBNAIL_WIDTH}:-2", '-f', 'image2', target]
+
+
+def sprite_command(source: str, target: str, duration: float) -> list[str]:
+    # one keyframe every duration/SPRITE_TILES seconds, side by side in a single jpg
+    step = max(duration / SPRITE_TILES, 1)
+    frames = f"select='isnan(prev_selected_t)+gte(t-prev_selected_t,{step:.1f})'," \
+             f"scale={THUMBNAIL_WIDTH // 2}:-2,tile={SPRITE_TILES}x1"
+    return [*LOW_PRIORITY, 'ffmpeg', '-hide_banner', '-loglevel', 'error', '-y',
+            '-skip_frame', 'nokey', '-i', source,
+            '-vf', frames, '-vsync', 'vfr', '-frames:v', '1', '-f', 'image2', target]
+
+
+class ThumbnailCache:
+    """
+    Poster frames and preview sprites on disk, keyed by file name and mtime so a rewritten file never
+    shows a stale preview. Bounded to max_bytes, least recently used entries go first (hits touch the mtime).
+    """
+
+    def __init__(self, directory: str = THUMBNAIL_DIR, max_bytes: int = THUMBNAIL_CACHE_MB * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def path(self, name: str, mtime: int, kind: str) -> str:
+        return os.path.join(self.directory, f"{name}.{mtime}.{kind}.jpg")
+
+    def get(self, name: str, mtime: int, kind: str) -> str | None:
+        path = self.path(name, mtime, kind)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def generate(self, source: str, mtime: int, duration: float | None, kinds: tuple = PREVIEW_KINDS) -> bool:
+        """Writes the previews of source, each through a temp file so readers never see half a jpg."""
+        os.makedirs(self.directory, exist_ok=True)
+        name = os.path.basename(source)
+        for kind in kinds:
+            command = poster_command if kind == 'poster' else sprite_command
+            target = self.path(name, mtime, kind)
+            if os.path.exists(target):
+                continue
+            tmp_path = f"{target}.tmp"
+            args = (source, tmp_path) if kind == 'poster' else (source, tmp_path, duration or 0)
+            result = subprocess.run(command(*args), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=60)
+            if result.returncode != 0 or not os.path.exists(tmp_path):
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                return False
+            os.replace(tmp_path, target)
+        self.prune()
+        return True
+
+    def prune(self):
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith('.jpg'):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, entry.path, stat.st_size))
+
+        total = sum(size for _, _, size in entries)
+        for _, path, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+class ThumbnailWorker:
+    """
+    Renders previews one at a time in a background thread: as SegmentFinalizer subscriber (submit) for every
+    published video, and for cache misses of dvr_web (request), so opening a long list never forks an ffmpeg
+    per file.
+    """
+
+    def __init__(self, logger, cache: ThumbnailCache | None = None):
+        self.logger = logger
+        self.cache = cache or ThumbnailCache()
+        self._queue = queue.Queue()
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            self._start()
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='thumbnails', daemon=True)
+            self._thread.start()
+
+    def submit(self, path: str, duration: float | None = None):
+        if path.endswith(VIDEO_FILE_EXTENSION) and parse_material_name(path) is not None:
+            self.request(path, duration)
+
+    def request(self, path: str, duration: float | None = None, kinds: tuple = PREVIEW_KINDS):
+        """Queues previews of any video, once until they are rendered. The thread starts with the first request."""
+        with self._lock:
+            if (path, kinds) in self._queued:
+                return
+            self._queued.add((path, kinds))
+            self._start()
+        self._queue.put((path, duration, kinds))
+
+    def _run(self):
+        while True:
+            path, duration, kinds = self._queue.get()
+            try:
+                self._render(path, duration, kinds)
+            finally:
+                with self._lock:
+                    self._queued.discard((path, kinds))
+
+    def _render(self, path: str, duration: float | None, kinds: tuple):
+        try:
+            mtime = int(os.stat(path).st_mtime)
+        except FileNotFoundError:
+            return  # evicted or uploaded before its turn
+        try:
+            if not self.cache.generate(path, mtime, duration, kinds):
+                self.logger.error(f"Failed to render preview of {path}")
+        except (OSError, subprocess.SubprocessError) as e:
+            self.logger.error(f"Failed to render preview of {path}: {e}")
@@ -0,0 +1,71 @@
+import bisect
+
+from .materials_index import estimated_durations
+
+
+class IntervalIndex:
+    """
+    Recorded intervals of one camera, built once from the index rows and queried with bisect.
+
+    Segments are kept sorted by start. No segment is longer than max_length, so the ones covering a moment
+    all start within max_length before it: point queries cost O(log n + k). Overlapping or touching
+    segments (closer than tolerance) are also merged into disjoint coverage spans, queried the same way.
+    """
+
+    def __init__(self, intervals: list[tuple[float, float, object]], tolerance: float = 0):
+        intervals = sorted(intervals, key=lambda interval: interval[0])
+        self.starts = [start for start, _, _ in intervals]
+        self.ends = [end for _, end, _ in intervals]
+        self.items = [item for _, _, item in intervals]
+        self.max_length = max((end - start for start, end, _ in intervals), default=0)
+
+        self.span_starts, self.span_ends = [], []
+        for start, end, _ in intervals:
+            if self.span_ends and start <= self.span_ends[-1] + tolerance:
+                self.span_ends[-1] = max(self.span_ends[-1], end)
+            else:
+                self.span_starts.append(start)
+                self.span_ends.append(end)
+
+    def __len__(self):
+        return len(self.items)
+
+    def at(self, moment: float) -> list:
+        """Items recorded at the moment."""
+        first = bisect.bisect_left(self.starts, moment - self.max_length)
+        last = bisect.bisect_right(self.starts, moment)
+        return [self.items[i] for i in range(first, last) if self.ends[i] > moment]
+
+    def coverage(self, start: float, end: float) -> list[tuple[float, float]]:
+        """Merged recorded spans clipped to [start, end)."""
+        # spans are disjoint and sorted, the one before the first starting after `start` may still reach into it
+        first = max(bisect.bisect_right(self.span_starts, start) - 1, 0)
+        last = bisect.bisect_left(self.span_starts, end)
+        return [(max(self.span_starts[i], start), min(self.span_ends[i], end))
+                for i in range(first, last) if self.span_ends[i] > start]
+
+    def gaps(self, start: float, end: float) -> list[tuple[float, float]]:
+        """Parts of [start, end) nothing was recorded in."""
+        gaps, cursor = [], start
+        for span_start, span_end in self.coverage(start, end):
+            if span_start > cursor:
+                gaps.append((cursor, span_start))
+            cursor = span_end
+        if cursor < end:
+            gaps.append((cursor, end))
+        return gaps
+
+
+def build_timelines(rows: list, max_duration: float, tolerance: float = 0) -> dict[int, IntervalIndex]:
+    """One IntervalIndex per camera from video rows sorted by start (MaterialsIndex.list_between), items are rows."""
+    by_camera = {}
+    for row in rows:
+        if row["camera"] is not None:
+            by_camera.setdefault(row["camera"], []).append(row)
+
+    timelines = {}
+    for camera, camera_rows in by_camera.items():
+        durations = estimated_durations(camera_rows, max_duration)
+        timelines[camera] = IntervalIndex([(row["start_ts"], row["start_ts"] + duration, row)
+                                           for row, duration in zip(camera_rows, durations)], tolerance)
+    return timelines
@@ -0,0 +1,171 @@
+import os
+import sqlite3
+import threading
+import time
+
+from .constants import UPLOAD_JOURNAL_FILE, UPLOAD_RETRY_BASE, UPLOAD_RETRY_MAX
+
+STATUS_QUEUED = 'queued'
+STATUS_IN_PROGRESS = 'in_progress'
+STATUS_VERIFIED = 'verified'
+STATUS_FAILED = 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS uploads (
+    local TEXT PRIMARY KEY,
+    remote TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    sent INTEGER NOT NULL DEFAULT 0,
+    updated INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'in_progress',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt INTEGER NOT NULL DEFAULT 0,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS uploads_status ON uploads (status, next_attempt);
+"""
+
+# columns added after the first release, rows from then were all started uploads
+MIGRATIONS = (
+    ("status", "TEXT NOT NULL DEFAULT 'in_progress'"),
+    ("attempts", "INTEGER NOT NULL DEFAULT 0"),
+    ("next_attempt", "INTEGER NOT NULL DEFAULT 0"),
+    ("error", "TEXT"),
+)
+
+
+def retry_delay(attempts: int, base: int = UPLOAD_RETRY_BASE, maximum: int = UPLOAD_RETRY_MAX) -> int:
+    """Seconds before the next try after `attempts` failures: base, 2 * base, 4 * base ... up to maximum."""
+    return min(base * 2 ** max(attempts - 1, 0), maximum)
+
+
+class UploadJournal:
+    """
+    State of every file mdvr_upload has seen, kept across runs and crashes:
+
+    queued -> in_progress -> verified, then the row is dropped once the local copy is removed.
+    A failed upload becomes failed and is retried after retry_delay(attempts), the other files go on meanwhile.
+    A file in the journal with the same size and mtime resumes from what the server already has instead of
+    being sent again, a verified one is not sent at all. Same SQLite setup as the materials index: WAL, one
+    connection per thread.
+    """
+
+    def __init__(self, path: str = UPLOAD_JOURNAL_FILE):
+        self.path = path
+        self._local = threading.local()
+
+    def _db(self) -> sqlite3.Connection:
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=10)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            existing = {row["name"] for row in db.execute("PRAGMA table_info(uploads)")}
+            if existing:
+                with db:
+                    for column, definition in MIGRATIONS:
+                        if column not in existing:
+                            db.execute(f"ALTER TABLE uploads ADD COLUMN {column} {definition}")
+            db.executescript(SCHEMA)
+            self._local.db = db
+        return db
+
+    def close(self):
+        db = getattr(self._local, 'db', None)
+        if db is not None:
+            db.close()
+            self._local.db = None
+
+    def get(self, local: str, remote: str, stat: os.stat_result) -> sqlite3.Row | None:
+        """The entry of this very file going to this destination, None if it was rewritten since."""
+        row = self._db().execute("SELECT * FROM uploads WHERE local = ?", (local,)).fetchone()
+        if row is None or row["remote"] != remote:
+            return None
+        if row["size"] != stat.st_size or row["mtime"] != int(stat.st_mtime):
+            return None  # the remote part is of another file
+        return row
+
+    def resumable(self, local: str, remote: str, stat: os.stat_result) -> sqlite3.Row | None:
+        """The entry of an interrupted upload, the server may have part of the file."""
+        row = self.get(local, remote, stat)
+        return row if row is not None and row["status"] in (STATUS_IN_PROGRESS, STATUS_FAILED) else None
+
+    def queue(self, entries: list[tuple[str, str]]):
+        """(local, remote) of files about to be uploaded. Known files keep their state unless rewritten."""
+        rows = []
+        now = int(time.time())
+        for local, remote in entries:
+            try:
+                stat = os.stat(local)
+            except FileNotFoundError:
+                continue
+            rows.append((local, remote, stat.st_size, int(stat.st_mtime), now))
+        db = self._db()
+        with db:
+            db.executemany("""
+                INSERT INTO uploads (local, remote, size, mtime, updated, status) VALUES (?, ?, ?, ?, ?, 'queued')
+                ON CONFLICT (local) DO UPDATE SET
+                    remote = excluded.remote, size = excluded.size, mtime = excluded.mtime, sent = 0,
+                    updated = excluded.updated, status = 'queued', attempts = 0, next_attempt = 0, error = NULL
+                WHERE uploads.remote != excluded.remote OR uploads.size != excluded.size
+                    OR uploads.mtime != excluded.mtime""", rows)
+
+    def deferred(self, now: float | None = None) -> set[str]:
+        """Local paths of failed uploads still waiting for their next attempt."""
+        rows = self._db().execute("SELECT local FROM uploads WHERE status = ? AND next_attempt > ?",
+                                  (STATUS_FAILED, int(now or time.time())))
+        return {row["local"] for row in rows}
+
+    def start(self, local: str, remote: str, stat: os.stat_result, sent: int = 0):
+        db = self._db()
+        with db:
+            db.execute("""
+                INSERT INTO uploads (local, remote, size, mtime, sent, updated, status) VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (local) DO UPDATE SET
+                    remote = excluded.remote, size = excluded.size, mtime = excluded.mtime, sent = excluded.sent,
+                    updated = excluded.updated, status = excluded.status""",
+                       (local, remote, stat.st_size, int(stat.st_mtime), sent, int(time.time()), STATUS_IN_PROGRESS))
+
+    def progress(self, local: str, sent: int):
+        db = self._db()
+        with db:
+            db.execute("UPDATE uploads SET sent = ?, updated = ? WHERE local = ?", (sent, int(time.time()), local))
+
+    def verify(self, local: str):
+        """The server has the whole file, only the local cleanup is left."""
+        db = self._db()
+        with db:
+            db.execute("UPDATE uploads SET status = ?, sent = size, updated = ?, error = NULL WHERE local = ?",
+                       (STATUS_VERIFIED, int(time.time()), local))
+
+    def fail(self, local: str, error: str) -> int:
+        """Records a failed try, returns the seconds until the next one."""
+        db = self._db()
+        row = db.execute("SELECT attempts FROM uploads WHERE local = ?", (local,)).fetchone()
+        attempts = (row["attempts"] if row else 0) + 1
+        delay = retry_delay(attempts)
+        now = int(time.time())
+        with db:
+            db.execute("UPDATE uploads SET status = ?, attempts = ?, next_attempt = ?, updated = ?, error = ? "
+                       "WHERE local = ?", (STATUS_FAILED, attempts, now + delay, now, error, local))
+        return delay
+
+    def finish(self, local: str):
+        db = self._db()
+        with db:
+            db.execute("DELETE FROM uploads WHERE local = ?", (local,))
+
+    def prune(self) -> int:
+        """Drops entries of files that are gone locally (evicted, or removed after a crash). Returns how many."""
+        db = self._db()
+        gone = [(row["local"],) for row in db.execute("SELECT local FROM uploads") if not os.path.exists(row["local"])]
+        with db:
+            db.executemany("DELETE FROM uploads WHERE local = ?", gone)
+        return len(gone)
+
+    def counts(self) -> dict[str, int]:
+        return {status: count for status, count in
+                self._db().execute("SELECT status, COUNT(*) FROM uploads GROUP BY status")}
@@ -0,0 +1,167 @@
+import asyncio
+import json
+import os
+import time
+
+from pythonping import ping
+
+from .constants import VPN_DNS, UPLOAD_STATS_FILE, UPLOAD_LATENCY_INTERVAL, UPLOAD_LATENCY_FACTOR, \
+    UPLOAD_MIN_RATE_KBPS
+from .utils import read_config, get_config_path
+
+
+class TokenBucket:
+    """Byte rate limiter shared by all upload sessions. rate None means unlimited, it can change at any time."""
+
+    def __init__(self, rate: float | None = None, burst_seconds: float = 1):
+        self.burst_seconds = burst_seconds
+        self.rate = None
+        self.tokens = 0
+        self.consumed = 0
+        self._updated = time.monotonic()
+        self.set_rate(rate)
+
+    def set_rate(self, rate: float | None):
+        self._refill()
+        self.rate = rate if rate and rate > 0 else None
+        if self.rate is not None:
+            self.tokens = min(self.tokens, self.rate * self.burst_seconds)
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate is not None:
+            self.tokens = min(self.tokens + (now - self._updated) * self.rate, self.rate * self.burst_seconds)
+        self._updated = now
+
+    async def consume(self, size: int):
+        """Waits until size bytes may be sent. Blocks bigger than the burst go through on a full bucket."""
+        self.consumed += size
+        while True:
+            self._refill()
+            if self.rate is None:
+                return
+            needed = min(size, self.rate * self.burst_seconds)
+            if self.tokens >= needed:
+                self.tokens -= size  # may go negative for a block above the burst, later blocks wait it off
+                return
+            await asyncio.sleep((needed - self.tokens) / self.rate)
+
+
+def ping_ms(host: str = VPN_DNS, timeout: int = 2) -> float | None:
+    """Round trip to the VPN server, None when it does not answer. Blocking, ICMP needs root."""
+    try:
+        response = ping(host, timeout=timeout, count=3)
+    except OSError:
+        return None
+    return response.rtt_avg_ms if response.success() else None
+
+
+class LinkShaper:
+    """
+    Upload rate for the cellular link shared with the VPN and live view: ftp.rate_limit_kbps from the config
+    (re-read while uploading, 0 means unlimited), lowered further when VPN latency rises above
+    UPLOAD_LATENCY_FACTOR times its baseline. Every slow probe halves the rate, down to UPLOAD_MIN_RATE_KBPS,
+    every normal one gives back a tenth of the throughput seen before the first backoff.
+    The state is published to UPLOAD_STATS_FILE.
+    """
+
+    def __init__(self, logger, probe=ping_ms, interval: float = UPLOAD_LATENCY_INTERVAL,
+                 factor: float = UPLOAD_LATENCY_FACTOR, stats_path: str = UPLOAD_STATS_FILE):
+        self.logger = logger
+        self.probe = probe
+        self.interval = interval
+        self.factor = factor
+        self.stats_path = stats_path
+        self.bucket = TokenBucket()
+        self.limit = None
+        self.adaptive = None
+        self.ceiling = None
+        self.baseline = None
+        self.rtt = None
+        self._config_mtime = None
+
+    def load_limit(self):
+        try:
+            mtime = os.path.getmtime(get_config_path())
+            if mtime == self._config_mtime:
+                return
+            self._config_mtime = mtime
+            kbps = int(read_config().get('ftp', {}).get('rate_limit_kbps', 0))
+        except (OSError, ValueError, TypeError) as e:
+            self.logger.error(f"Failed to read the upload rate limit: {e}")
+            return
+        limit = kbps * 1024 if kbps > 0 else None
+        if limit != self.limit:
+            self.logger.info(f"Upload rate limit set to {kbps or 'unlimited'} KiB/s.")
+            self.limit = limit
+            self._apply()
+
+    def effective(self) -> float | None:
+        rates = [rate for rate in (self.limit, self.adaptive) if rate]
+        return min(rates) if rates else None
+
+    def _apply(self):
+        self.bucket.set_rate(self.effective())
+
+    def observe(self, rtt: float | None, throughput: float):
+        """One latency probe, throughput is what was sent since the previous one (bytes/s)."""
+        self.rtt = rtt
+        if rtt is None:
+            return  # no answer tells nothing about the load we put on the link
+        if self.baseline is None or rtt < self.baseline:
+            self.baseline = rtt
+        else:
+            # follows slow route changes up, a single busy period does not become the new normal
+            self.baseline += (rtt - self.baseline) * 0.01
+
+        floor = UPLOAD_MIN_RATE_KBPS * 1024
+        if rtt > self.baseline * self.factor:
+            current = self.effective() or max(throughput, floor)
+            self.ceiling = self.ceiling or current
+            self.adaptive = max(current / 2, floor)
+            self.logger.info(f"VPN latency {rtt:.0f} ms (baseline {self.baseline:.0f} ms), "
+                             f"upload slowed to {self.adaptive / 1024:.0f} KiB/s.")
+        elif self.adaptive is not None:
+            self.adaptive += self.ceiling / 10
+            if self.adaptive >= self.ceiling:
+                self.adaptive, self.ceiling = None, None
+        self._apply()
+
+    def publish(self):
+        stats = {
+            "updated": int(time.time()),
+            "limit": self.limit,
+            "effective": self.effective(),
+            "rtt_ms": self.rtt,
+            "baseline_ms": self.baseline,
+            "sent": self.bucket.consumed,
+        }
+        try:
+            os.makedirs(os.path.dirname(self.stats_path), exist_ok=True)
+            tmp_path = f"{self.stats_path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(stats, f)
+            os.replace(tmp_path, self.stats_path)
+        except OSError:
+            pass
+
+    async def monitor(self):
+        """Runs next to the uploads until cancelled."""
+        self.load_limit()
+        consumed, started = self.bucket.consumed, time.monotonic()
+        while True:
+            self.publish()
+            await asyncio.sleep(self.interval)
+            self.load_limit()
+            rtt = await asyncio.to_thread(self.probe)
+            now = time.monotonic()
+            self.observe(rtt, (self.bucket.consumed - consumed) / (now - started))
+            consumed, started = self.bucket.consumed, now
+
+
+def read_upload_stats(path: str = UPLOAD_STATS_FILE) -> dict | None:
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
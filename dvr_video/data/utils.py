@@ -1,16 +1,18 @@
 import asyncio
 import json
-import time
 import os
 import re
 import shutil
+import signal
 import subprocess
-import threading
 
 from datetime import datetime
 from typing import List
 
-from .constants import CONFIG_FILENAME
+from .constants import CONFIG_FILENAME, DATE_FORMAT, TEMP_DIR, FRAGMENTED_MOVFLAGS, FASTSTART_MOVFLAGS, \
+    PARTITION_DATE_FORMAT, PROGRAM_OPTIONS_KEY, MATERIALS_LAYOUT_FLAT, MATERIALS_LAYOUT_PARTITIONED
+
+MATERIAL_NAME_PATTERN = re.compile(r'^(\d+?)24(\d{12})(?:_E(\d{12}))?\.')
 
 
 def get_config_path():
@@ -39,14 +41,61 @@ async def get_date(video):
     return date
 
 
-def move():
-    content = os.listdir("temp")
+def duration_to_seconds(duration: str | int) -> int:
+    # "00:02:00" -> 120
+    if isinstance(duration, int):
+        return duration
+    seconds = 0
+    for part in str(duration).split(':'):
+        seconds = seconds * 60 + int(part)
+    return seconds
+
+
+def closed_segments(current_link: int, include_open: bool = False) -> list[str]:
+    """
+    Returns the staged files of one camera that ffmpeg has closed.
+    The newest one is still being written unless include_open is set (the process has exited).
+    """
+    prefix = f"{current_link + 1}24"
+    segments = sorted(i for i in os.listdir(TEMP_DIR) if i.startswith(prefix))
+
+    if not include_open:
+        segments = segments[:-1]
+
+    return [os.path.join(TEMP_DIR, i) for i in segments]
+
+
+def parse_material_name(filename: str) -> tuple[int, datetime, str | None] | None:
+    # 224250109081232.mp4 -> (2, 2025-01-09 08:12:32, None)
+    # 224250109081232_E250109081000.mp4 -> (2, 2025-01-09 08:12:32, '250109081000')
+    match = MATERIAL_NAME_PATTERN.match(os.path.basename(filename))
+    if not match:
+        return None
+    try:
+        return int(match.group(1)), datetime.strptime(match.group(2), DATE_FORMAT), match.group(3)
+    except ValueError:
+        return None
 
-    for i in content:
-        shutil.move(
-            f"temp/{i}",
-            f"/etc/mdvr/materials/{i}"
-        )
+
+def is_partitioned(config: dict) -> bool:
+    return config[PROGRAM_OPTIONS_KEY].get('materials_layout', MATERIALS_LAYOUT_FLAT) == MATERIALS_LAYOUT_PARTITIONED
+
+
+def material_relpath(filename: str, partitioned: bool) -> str:
+    # 124250109081232.mp4 -> 250109/cam1/124250109081232.mp4 in the partitioned layout
+    parsed = parse_material_name(filename) if partitioned else None
+    if parsed is None:
+        return filename
+    camera, start, _ = parsed
+    return os.path.join(start.strftime(PARTITION_DATE_FORMAT), f"cam{camera}", filename)
+
+
+def mp4_output_options(fragmented: bool, segmented: bool = False) -> dict:
+    movflags = FRAGMENTED_MOVFLAGS if fragmented else FASTSTART_MOVFLAGS
+    if segmented:
+        # the segment muxer passes these to the mp4 muxer of every segment
+        return {'segment_format_options': f'movflags={movflags}'}
+    return {'movflags': movflags}
 
 
 def file_date_sort(file_list: List[str]) -> List[str]:
@@ -83,8 +132,19 @@ async def extract_date_from_filename_async(filename: str) -> str | None:
     return await asyncio.to_thread(extract_date_from_filename, filename)
 
 
-def generate_file_output_name(current_link: int, filename: str, file_extension: str) -> str:
-    return f"temp/{current_link + 1}24{filename}{file_extension}"
+def _event_suffix(event_id: str | None) -> str:
+    # segments of one reed switch event share its id, the event start time
+    return f"_E{event_id}" if event_id else ""
+
+
+def generate_file_output_name(current_link: int, filename: str, file_extension: str,
+                              event_id: str | None = None) -> str:
+    return os.path.join(TEMP_DIR, f"{current_link + 1}24{filename}{_event_suffix(event_id)}{file_extension}")
+
+
+def generate_segment_output_pattern(current_link: int, file_extension: str, event_id: str | None = None) -> str:
+    # strftime pattern for the segment muxer, expands to the same name as generate_file_output_name
+    return os.path.join(TEMP_DIR, f"{current_link + 1}24{DATE_FORMAT}{_event_suffix(event_id)}{file_extension}")
 
 
 def get_ext5v_v():
@@ -142,32 +202,6 @@ def stop_ffmpeg(proc, logger, timeout: float = 5.0):
             return proc.returncode
     
 
-def monitor_ffmpeg(proc, logger, camera_name: str, stop_event: threading.Event, max_restarts: int = 0):
-    """
-    Reads process stderr line by line, logs and raises errors in the logger.
-    If the process has exited — returns. For simplicity, restarts are not performed by default (max_restarts=0). 
-    If auto-restart is needed, max_restarts can be increased.
-    """
-    restarts = 0
-    while not stop_event.is_set():
-        if proc.poll() is not None:
-            rc = proc.returncode
-            if rc != 0 and rc != 255:
-                logger.error(f"ffmpeg process ({camera_name}) exited with code {rc}")
-            break
-
-        if proc.stderr is None:
-            time.sleep(0.1)
-            continue
-
-        raw = proc.stderr.readline()
-
-        if not raw:
-            time.sleep(0.05)
-            continue
-
-        line = raw.decode('utf-8', errors='replace').strip()
-        logger.debug(f"[ffmpeg {camera_name}] {line}")
-        lower = line.lower()
-        if 'error' in lower or 'failed' in lower or 'connection timed out' in lower or 'server returned' in lower:
-            logger.error(f"FFMPEG ERROR [{camera_name}]: {line}")
+def is_ffmpeg_error_line(line: str) -> bool:
+    lower = line.lower()
+    return 'error' in lower or 'failed' in lower or 'connection timed out' in lower or 'server returned' in lower
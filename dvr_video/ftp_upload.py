@@ -2,6 +2,8 @@ import asyncio
 import pathlib
 
 from data.ftp import FTPCon
+from data.ftp_pool import ThroughputTuner
+from data.upload_shaping import LinkShaper
 from data.utils import read_config
 from data.LoggerFactory import DefaultLoggerFactory
 
@@ -23,9 +25,8 @@ async def main():
 
     ftp = FTPCon(server, port, user, password, car_name)
 
-    await ftp.upload_start_system_log()
-    await ftp.upload_logs_to_ftp(logger)
-    await ftp.upload_to_ftp(logger)
+    # one prioritized queue for materials and logs, shaped to leave room for the VPN and live view
+    await ftp.upload_all(logger, ThroughputTuner.from_config(config[ftp_config_key]), LinkShaper(logger))
 
 
 if __name__ == "__main__":
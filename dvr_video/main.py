@@ -1,112 +1,109 @@
+import asyncio
 import pathlib
-import threading
 import ffmpeg
-import time
 
 from datetime import datetime
-from data.utils import read_config, move, generate_file_output_name, stop_ffmpeg, monitor_ffmpeg
+from functools import partial
+from data.utils import read_config, generate_file_output_name, closed_segments, duration_to_seconds, is_partitioned
+from data.supervisor import CameraJob, CameraSupervisor
+from data.metrics import MetricsPublisher
+from data.finalizer import SegmentFinalizer
+from data.materials_index import MaterialsIndex
+from data.storage import SpaceReserver, ReservationWorker
+from data.thumbnails import ThumbnailWorker
 from sdnotify import SystemdNotifier
 
-from data.constants import VIDEO_OPTIONS_KEY, RTSP_OPTIONS_KEY, WATCH_DOG_NOTIFICATION, PROGRAM_OPTIONS_KEY, \
-    DATE_FORMAT, DIR_NAME, CAMERA_LIST_KEY, VIDEO_FILE_EXTENSION, RTSP_X, RTSP_Y, FPS
+from data.constants import VIDEO_OPTIONS_KEY, PROGRAM_OPTIONS_KEY, DATE_FORMAT, DIR_NAME, CAMERA_LIST_KEY, \
+    VIDEO_FILE_EXTENSION, CAMERA_STALL_GRACE, FPS, TEMP_DIR
 from data.LoggerFactory import DefaultLoggerFactory
-from main_common import async_write_photo
+from main_common import build_photo_engine_output, build_video_output, build_segments_output, resolve_record_mode, \
+    video_container_options, publish_material, reserve_next_round
 
 config = read_config()
 logger = DefaultLoggerFactory.create_logger('mdvr_engine', "engine.log")
 notifier = SystemdNotifier()
 notifier.notify('READY=1')
+finalizer = SegmentFinalizer(logger, partitioned=is_partitioned(config))
+index = MaterialsIndex()
+thumbnails = ThumbnailWorker(logger)
 
 
-def write_media(current_link: int, file_name: str, mode, config: dict):
-    return async_write_photo(current_link,
-                                   file_name,
-                                   config) if mode \
-        else async_write_video(current_link,
-                                     file_name)
-
-
-def async_write_video(current_link: int, file_name: str):
+def video_command(current_link: int) -> list[str]:
+    file_name = datetime.now().strftime(DATE_FORMAT)
     stream = ffmpeg.input(config[CAMERA_LIST_KEY][current_link],
                           t=str(config[VIDEO_OPTIONS_KEY]['video_duration']),
                           rtsp_transport='tcp')
-    stream = ffmpeg.filter(stream,
-                           'scale',
-                           width=config[RTSP_OPTIONS_KEY][RTSP_X],
-                           height=config[RTSP_OPTIONS_KEY][RTSP_Y])
-    stream = ffmpeg.filter(stream,
-                           'fps',
-                           fps=config[VIDEO_OPTIONS_KEY][FPS])
-    stream = ffmpeg.output(stream,
-                           generate_file_output_name(current_link,
-                                                     file_name,
-                                                     VIDEO_FILE_EXTENSION),
-                           vcodec="libx264")
-    process = ffmpeg.run_async(stream)
-
-    return process
+    stream = build_video_output(stream,
+                                generate_file_output_name(current_link,
+                                                          file_name,
+                                                          VIDEO_FILE_EXTENSION),
+                                resolve_record_mode(current_link, config, logger),
+                                config,
+                                **video_container_options(config))
+
+    return ffmpeg.compile(stream)
+
+
+def segments_command(current_link: int) -> list[str]:
+    return ffmpeg.compile(build_segments_output(current_link, config, logger))
+
+
+def photos_command(current_link: int, photo_timeout: int) -> list[str]:
+    return ffmpeg.compile(build_photo_engine_output(current_link, photo_timeout, config))
+
+
+def create_camera_job(current_link: int, photo_mode: bool, continuous: bool, photo_timeout: int) -> CameraJob:
+    name = f"camera_{current_link + 1}"
+    finalize_all = lambda rc: finalizer.submit(closed_segments(current_link, include_open=True))
+    finalize_closed = lambda: finalizer.submit(closed_segments(current_link))
+
+    if photo_mode:
+        # the newest photo may still be written, it is finalized on the next tick
+        return CameraJob(name,
+                         partial(photos_command, current_link, photo_timeout),
+                         on_exit=finalize_all,
+                         on_tick=finalize_closed,
+                         stall_timeout=photo_timeout + CAMERA_STALL_GRACE)
+
+    if continuous:
+        return CameraJob(name,
+                         partial(segments_command, current_link),
+                         on_exit=finalize_all,
+                         on_tick=finalize_closed)
+
+    video_duration = duration_to_seconds(config[VIDEO_OPTIONS_KEY]['video_duration'])
+    return CameraJob(name,
+                     partial(video_command, current_link),
+                     on_exit=finalize_all,
+                     max_runtime=video_duration + CAMERA_STALL_GRACE)
 
 
 def main():
-    pathlib.Path("temp").mkdir(exist_ok=True)
+    pathlib.Path(TEMP_DIR).mkdir(parents=True, exist_ok=True)
     pathlib.Path(DIR_NAME).mkdir(parents=True, exist_ok=True)
     photo_mode = bool(config[PROGRAM_OPTIONS_KEY]['photo_mode'])
     photo_timeout = int(config['photo_timeout'])
-
-    move()
-
-    while True:
-        jobs, links_names = [], []
-
-        for current_link in range(len(config[CAMERA_LIST_KEY])):
-            file_name = datetime.now().strftime(DATE_FORMAT)
-            try:
-                # 0 - video, 1 - photo
-                process = write_media(current_link,
-                                            file_name,
-                                            photo_mode,
-                                            config)
-            except Exception as e:
-                logger.error(f"Failed to initialize camera {e}")
-                continue
-
-            stop_event = threading.Event()
-            camera_name = f"camera_{current_link}_{file_name}"
-            t = threading.Thread(target=monitor_ffmpeg, args=(process, logger, camera_name, stop_event), daemon=True)
-            t.start()
-
-            jobs.append({
-                "proc": process,
-                "monitor_thread": t,
-                "stop_event": stop_event,
-                "name": camera_name
-            })
-            links_names.append(str(current_link + 1) + "24" + file_name)
-
-        for process in jobs:
-            proc = process.get("proc")
-            proc.wait()
-        if not photo_mode:
-            for count, process in enumerate(jobs):
-                proc = process.get("proc")
-                stop_event = process.get("stop_event")
-                if stop_event:
-                    stop_event.set()
-                try:
-                    rc = stop_ffmpeg(proc, logger, timeout=5)
-                    if rc is not None and rc not in (0, 255):
-                        logger.error(f"Camera unavailable. Return code: {rc}")
-                    notifier.notify(WATCH_DOG_NOTIFICATION)
-                except Exception as e:
-                    logger.critical(f"Error while stopping ffmpeg process: {e}")
-        else:
-            notifier.notify(WATCH_DOG_NOTIFICATION)
-
-        jobs.clear()
-        move()
-
-        if photo_timeout == 1:
-            time.sleep(photo_timeout)
+    continuous = bool(config[VIDEO_OPTIONS_KEY].get('continuous', 0))
+
+    metrics = MetricsPublisher(config[VIDEO_OPTIONS_KEY][FPS])
+    finalizer.subscribe(metrics.segment_finalized)
+    finalizer.subscribe(partial(publish_material, index, thumbnails))
+    # a finalized segment means the next round has started, make room for the one after it
+    reservations = ReservationWorker(partial(reserve_next_round, SpaceReserver(index, logger), metrics, config),
+                                     logger)
+    finalizer.subscribe(lambda path: reservations.request())
+    reservations.start()
+    finalizer.start()
+    thumbnails.start()
+    index.reconcile()
+    finalizer.recover()
+
+    supervisor = CameraSupervisor(logger, notifier, metrics=metrics)
+    for current_link in range(len(config[CAMERA_LIST_KEY])):
+        supervisor.add(create_camera_job(current_link, photo_mode, continuous, photo_timeout))
+
+    asyncio.run(supervisor.run())
+    finalizer.stop()
 
 
 if __name__ == "__main__":
@@ -1,16 +1,188 @@
+import time
+
 import ffmpeg
 
-from data.constants import PHOTO_FILE_EXTENSION, CAMERA_LIST_KEY, RTSP_OPTIONS_KEY
-from data.utils import generate_file_output_name
+from data.constants import PHOTO_FILE_EXTENSION, CAMERA_LIST_KEY, RTSP_OPTIONS_KEY, VIDEO_OPTIONS_KEY, RTSP_X, \
+    RTSP_Y, FPS, RECORD_MODE_AUTO, RECORD_MODE_COPY, RECORD_MODE_TRANSCODE, COPY_CODECS, VIDEO_FILE_EXTENSION, \
+    PROGRAM_OPTIONS_KEY, RECORD_MODE_PROBE_RETRY
+from data.utils import generate_file_output_name, generate_segment_output_pattern, mp4_output_options, \
+    duration_to_seconds
+from data.storage import round_bytes
+from data.mp4info import read_mp4_info
+
+_record_modes = {}
+_probe_retry = {}  # camera -> monotonic time of the next probe after a failed one
+
+
+def build_photo_output(current_link: int, file_name: str, config: dict):
+    stream = ffmpeg.input(config[CAMERA_LIST_KEY][current_link],
+                          rtsp_transport=config[RTSP_OPTIONS_KEY]['rtsp_transport'])
+    return ffmpeg.output(stream,
+                         generate_file_output_name(current_link,
+                                                   file_name,
+                                                   PHOTO_FILE_EXTENSION),
+                         format='image2',
+                         vframes=1)
 
 
-async def async_write_photo(current_link: int, file_name: str, config: dict):
+def build_photo_engine_output(current_link: int, photo_timeout: int, config: dict):
+    # One decoder per camera, the fps filter emits a frame every photo_timeout seconds.
     stream = ffmpeg.input(config[CAMERA_LIST_KEY][current_link],
                           rtsp_transport=config[RTSP_OPTIONS_KEY]['rtsp_transport'])
-    stream = ffmpeg.output(stream,
-                           generate_file_output_name(current_link,
-                                                     file_name,
-                                                     PHOTO_FILE_EXTENSION),
-                           format='image2')
-    process = ffmpeg.run_async(stream)
+    stream = ffmpeg.filter(stream,
+                           'fps',
+                           fps=f"1/{max(1, photo_timeout)}")
+    return ffmpeg.output(stream,
+                         generate_segment_output_pattern(current_link,
+                                                         PHOTO_FILE_EXTENSION),
+                         format='image2',
+                         strftime=1)
+
+
+def write_photo(current_link: int, file_name: str, config: dict):
+    process = ffmpeg.run_async(build_photo_output(current_link, file_name, config))
     return process
+
+
+def probe_video_stream(url: str) -> dict | None:
+    info = ffmpeg.probe(url,
+                        rtsp_transport='tcp',
+                        select_streams='v:0',
+                        timeout='5000000')
+    streams = info.get('streams') or []
+    return streams[0] if streams else None
+
+
+def probe_media(path: str) -> dict | None:
+    # the recorder's own segments, read from their boxes instead of forking ffprobe for each one
+    if not path.endswith(VIDEO_FILE_EXTENSION):
+        return None
+    try:
+        return read_mp4_info(path)
+    except (OSError, ValueError):
+        return None
+
+
+def parse_frame_rate(rate: str | None) -> float | None:
+    # "15/1" -> 15.0
+    try:
+        num, _, den = str(rate).partition('/')
+        return float(num) / float(den or 1)
+    except (TypeError, ValueError, ZeroDivisionError):
+        return None
+
+
+def can_stream_copy(video_stream: dict, config: dict) -> bool:
+    if video_stream.get('codec_name') not in COPY_CODECS:
+        return False
+
+    if video_stream.get('width') != int(config[RTSP_OPTIONS_KEY][RTSP_X]) or \
+            video_stream.get('height') != int(config[RTSP_OPTIONS_KEY][RTSP_Y]):
+        return False
+
+    fps = parse_frame_rate(video_stream.get('avg_frame_rate')) or parse_frame_rate(video_stream.get('r_frame_rate'))
+    return fps is not None and abs(fps - float(config[VIDEO_OPTIONS_KEY][FPS])) < 0.5
+
+
+def resolve_record_mode(current_link: int, config: dict, logger) -> str:
+    """
+    Returns 'copy' or 'transcode' for the camera. video_options.record_mode is 'auto', 'copy' or 'transcode',
+    or a list with one of those per camera. In auto mode the camera is probed once and remuxed as is
+    when it already delivers H.264/H.265 with the configured resolution and fps. An unreachable camera
+    records in transcode mode and is probed again at most every RECORD_MODE_PROBE_RETRY seconds, so
+    restarting it does not wait for an RTSP timeout each time.
+    """
+    if current_link in _record_modes:
+        return _record_modes[current_link]
+
+    mode = config[VIDEO_OPTIONS_KEY].get('record_mode', RECORD_MODE_AUTO)
+    if isinstance(mode, list):
+        mode = mode[current_link] if current_link < len(mode) else RECORD_MODE_AUTO
+
+    if mode in (RECORD_MODE_COPY, RECORD_MODE_TRANSCODE):
+        _record_modes[current_link] = mode
+        return mode
+
+    if time.monotonic() < _probe_retry.get(current_link, 0):
+        return RECORD_MODE_TRANSCODE
+
+    try:
+        video_stream = probe_video_stream(config[CAMERA_LIST_KEY][current_link])
+    except ffmpeg.Error as e:
+        logger.error(f"Failed to probe camera {current_link + 1}, using transcode: {e.stderr}")
+        _probe_retry[current_link] = time.monotonic() + RECORD_MODE_PROBE_RETRY
+        return RECORD_MODE_TRANSCODE
+
+    mode = RECORD_MODE_COPY if video_stream and can_stream_copy(video_stream, config) else RECORD_MODE_TRANSCODE
+    logger.info(f"Camera {current_link + 1} record mode: {mode}")
+    _record_modes[current_link] = mode
+    return mode
+
+
+def build_video_output(stream, filename: str, mode: str, config: dict, **kwargs):
+    if mode == RECORD_MODE_COPY:
+        return ffmpeg.output(stream.video, filename, vcodec='copy', **kwargs)
+
+    stream = ffmpeg.filter(stream,
+                           'scale',
+                           width=config[RTSP_OPTIONS_KEY][RTSP_X],
+                           height=config[RTSP_OPTIONS_KEY][RTSP_Y])
+    stream = ffmpeg.filter(stream,
+                           'fps',
+                           fps=config[VIDEO_OPTIONS_KEY][FPS])
+    return ffmpeg.output(stream, filename, vcodec="libx264", **kwargs)
+
+
+def video_container_options(config: dict, segmented: bool = False) -> dict:
+    return mp4_output_options(bool(config[VIDEO_OPTIONS_KEY].get('fragmented', 1)), segmented)
+
+
+def build_segments_output(current_link: int, config: dict, logger, event_id: str | None = None, **input_options):
+    """
+    One RTSP session per camera, the segment muxer cuts files every video_duration. Continuous recording
+    (main) and event recording (main_rs, tagged with event_id) both use it.
+    """
+    segment_time = duration_to_seconds(config[VIDEO_OPTIONS_KEY]['video_duration'])
+    mode = resolve_record_mode(current_link, config, logger)
+    output_options = {}
+    if mode == RECORD_MODE_TRANSCODE:
+        # stream copy can only cut on the camera's own keyframes
+        output_options['force_key_frames'] = f"expr:gte(t,n_forced*{segment_time})"
+
+    stream = ffmpeg.input(config[CAMERA_LIST_KEY][current_link],
+                          rtsp_transport='tcp',
+                          **input_options)
+    return build_video_output(stream,
+                              generate_segment_output_pattern(current_link,
+                                                              VIDEO_FILE_EXTENSION,
+                                                              event_id),
+                              mode,
+                              config,
+                              f='segment',
+                              segment_time=segment_time,
+                              segment_format='mp4',
+                              reset_timestamps=1,
+                              strftime=1,
+                              **video_container_options(config, segmented=True),
+                              **output_options)
+
+
+def publish_material(index, thumbnails, path: str):
+    """SegmentFinalizer subscriber of both recorders: indexes the file and queues its previews."""
+    info = probe_media(path)
+    index.add(path, info)
+    thumbnails.submit(path, info and info["duration"])
+
+
+def reserve_next_round(reserver, metrics, config: dict, force: bool = False):
+    """Frees room for the next segment of every camera, from the write rates learned by metrics."""
+    photo_mode = bool(config[PROGRAM_OPTIONS_KEY]['photo_mode'])
+    seconds = int(config['photo_timeout']) if photo_mode \
+        else duration_to_seconds(config[VIDEO_OPTIONS_KEY]['video_duration'])
+    cameras = [f"camera_{current_link + 1}" for current_link in range(len(config[CAMERA_LIST_KEY]))]
+    if force:
+        reservation = reserver.reserve(round_bytes(metrics.rates(), cameras, seconds), config)
+    else:
+        reservation = reserver.reserve_round(metrics.rates(), cameras, seconds, config)
+    if reservation is not None:
+        metrics.reservation = reservation
@@ -1,55 +1,103 @@
+import os
 import pathlib
-import threading
 import ffmpeg
 import time
 
 from datetime import datetime
+from functools import partial
 from sdnotify import SystemdNotifier
 
-from data.constants import CAMERA_LIST_KEY, RTSP_OPTIONS_KEY, RTSP_X, RTSP_Y, VIDEO_OPTIONS_KEY, FPS, \
-    DIR_NAME, DATE_FORMAT, PROGRAM_OPTIONS_KEY, VIDEO_FILE_EXTENSION, WATCH_DOG_NOTIFICATION
-from data.utils import read_config, move, generate_file_output_name, stop_ffmpeg, monitor_ffmpeg
+from data.constants import CAMERA_LIST_KEY, DIR_NAME, DATE_FORMAT, PROGRAM_OPTIONS_KEY, PHOTO_FILE_EXTENSION, \
+    WATCH_DOG_NOTIFICATION, PREROLL_SEGMENT_SECONDS, RECORD_MODE_TRANSCODE, VIDEO_OPTIONS_KEY, FPS, STATS_INTERVAL, \
+    TEMP_DIR
+from data.utils import read_config, generate_file_output_name, stop_ffmpeg, closed_segments, duration_to_seconds, \
+    is_partitioned
+from data.finalizer import SegmentFinalizer
+from data.materials_index import MaterialsIndex
+from data.storage import SpaceReserver, ReservationWorker
+from data.thumbnails import ThumbnailWorker
+from data.ffmpeg_monitor import FfmpegMonitor, PROGRESS_ARGS
+from data.metrics import MetricsPublisher
 from data.LoggerFactory import LoggerFactory
-from main_common import async_write_photo
+from main_common import write_photo, build_video_output, build_segments_output, resolve_record_mode, \
+    video_container_options, publish_material, reserve_next_round
 from data.rs_utils import RSFactory
+from data.preroll import PrerollRing
 
 config = read_config()
 CustomFactory = LoggerFactory(level=20)
 logger = CustomFactory.create_logger('mdvr_engine', "engine.log")
 notifier = SystemdNotifier()
 notifier.notify('READY=1')
+monitor = FfmpegMonitor(logger)
+metrics = MetricsPublisher(config[VIDEO_OPTIONS_KEY][FPS])
+finalizer = SegmentFinalizer(logger, partitioned=is_partitioned(config))
+index = MaterialsIndex()
+finalizer.subscribe(metrics.segment_finalized)
+thumbnails = ThumbnailWorker(logger)
+reservations = ReservationWorker(partial(reserve_next_round, SpaceReserver(index, logger), metrics, config), logger)
 
 
-def async_write_video(current_link, file_name):
+finalizer.subscribe(partial(publish_material, index, thumbnails))
+finalizer.subscribe(lambda path: reservations.request())
+
+
+def async_write_video(current_link, event_id):
+    # The event is cut into video_duration segments, each finalized as soon as it closes.
+    stream = build_segments_output(current_link, config, logger, event_id,
+                                   fflags='+genpts',
+                                   **{'timeout': '15'}).global_args(*PROGRESS_ARGS)
+    process = ffmpeg.run_async(stream, pipe_stdout=True, pipe_stderr=True)
+    monitor.attach(f"camera_{current_link + 1}", process)
+    return process
+
+
+def async_write_preroll(current_link, pattern):
+    mode = resolve_record_mode(current_link, config, logger)
+    output_options = {}
+    if mode == RECORD_MODE_TRANSCODE:
+        output_options['force_key_frames'] = f"expr:gte(t,n_forced*{PREROLL_SEGMENT_SECONDS})"
+
     stream = ffmpeg.input(
         config[CAMERA_LIST_KEY][current_link],
         rtsp_transport='tcp',
         fflags='+genpts',
         **{'timeout': '15'}
     )
-    stream = ffmpeg.filter(
-        stream,
-        'scale',
-        width=config[RTSP_OPTIONS_KEY][RTSP_X],
-        height=config[RTSP_OPTIONS_KEY][RTSP_Y]
-    )
-    stream = ffmpeg.filter(
-        stream,
-        'fps',
-        fps=config[VIDEO_OPTIONS_KEY][FPS]
-    )
-    stream = ffmpeg.output(
+    stream = build_video_output(
         stream,
-        generate_file_output_name(current_link, file_name, VIDEO_FILE_EXTENSION),
-        vcodec="libx264"
-    )
+        pattern,
+        mode,
+        config,
+        f='segment',
+        segment_time=PREROLL_SEGMENT_SECONDS,
+        segment_format='mpegts',
+        **output_options
+    ).global_args(*PROGRESS_ARGS)
     process = ffmpeg.run_async(stream, pipe_stdout=True, pipe_stderr=True)
+    monitor.attach(f"preroll_{current_link + 1}", process)
     return process
 
 
+def create_preroll_rings(photo_mode: bool) -> list[PrerollRing]:
+    preroll_seconds = int(config['reed_switch'].get('preroll_seconds', 0))
+    if photo_mode or preroll_seconds <= 0:
+        return []
+
+    max_bytes = int(config['reed_switch'].get('preroll_max_mb', 64)) * 1024 * 1024
+    part_seconds = duration_to_seconds(config[VIDEO_OPTIONS_KEY]['video_duration'])
+    rings = []
+    for current_link in range(len(config[CAMERA_LIST_KEY])):
+        ring = PrerollRing(current_link, partial(async_write_preroll, current_link), logger, preroll_seconds, max_bytes,
+                           part_seconds, video_container_options(config))
+        ring.start()
+        rings.append(ring)
+    return rings
+
+
 def main():
-    jobs, links_names = [], []
-    pathlib.Path("temp").mkdir(exist_ok=True)
+    jobs = []
+    pathlib.Path(TEMP_DIR).mkdir(parents=True, exist_ok=True)
     pathlib.Path(DIR_NAME).mkdir(parents=True, exist_ok=True)
     photo_mode = bool(config[PROGRAM_OPTIONS_KEY]['photo_mode'])
     video_status = False
@@ -57,54 +105,86 @@ def main():
     rs = RSFactory.create(impulseCheck)
     rs.setup()
 
-    move()
+    reservations.start()
+    finalizer.start()
+    thumbnails.start()
+    index.reconcile()
+    finalizer.recover()
+    rings = create_preroll_rings(photo_mode)
+
+    next_publish = 0
 
     while True:
         notifier.notify(WATCH_DOG_NOTIFICATION)
+        for ring in rings:
+            ring.poll()
+        if time.monotonic() >= next_publish:
+            try:
+                metrics.publish(dict(monitor.progress))
+            except OSError as e:
+                logger.error(f"Failed to publish metrics: {e}")
+            next_publish = time.monotonic() + STATS_INTERVAL
+        # event parts are written in the background, during the event and after it ended
+        for ring in rings:
+            finalizer.submit(ring.take_parts())
+        if video_status:
+            for entry in jobs:
+                if entry["output"] is None:
+                    finalizer.submit(closed_segments(entry["link"]))
         door_state = rs.pressed()
 
-        if door_state is True and video_status is False:
+        if door_state is True and video_status is False and rings:
+            # the rings keep recording through the debounce, so it does not cost footage
+            time.sleep(0.5)
+            if rs.pressed() is True:
+                event_id = datetime.now().strftime(DATE_FORMAT)
+                for ring in rings:
+                    ring.begin_event(event_id)
+                video_status = True
+        elif door_state is True and video_status is False:
             time.sleep(0.5)
             door_state = rs.pressed()
             if door_state is True:
+                event_id = datetime.now().strftime(DATE_FORMAT)
                 for current_link in range(len(config[CAMERA_LIST_KEY])):
                     now = datetime.now()
                     file_name = now.strftime(DATE_FORMAT)
 
                     try:
                         # 0 - video, 1 - photo
-                        process = async_write_photo(current_link,
-                                                     file_name,
-                                                     VIDEO_FILE_EXTENSION) if photo_mode \
+                        process = write_photo(current_link,
+                                              file_name,
+                                              config) if photo_mode \
                             else async_write_video(current_link,
-                                                   file_name)
+                                                   event_id)
                     except Exception as e:
                         logger.error(f"Failed to initialize camera {e}")
                         continue
 
-                    stop_event = threading.Event()
                     camera_name = f"camera_{current_link}_{file_name}"
-                    t = threading.Thread(target=monitor_ffmpeg, args=(process, logger, camera_name, stop_event), daemon=True)
-                    t.start()
-
                     jobs.append({
                         "proc": process,
-                        "monitor_thread": t,
-                        "stop_event": stop_event,
-                        "name": camera_name
+                        "name": camera_name,
+                        "link": current_link,
+                        # video segments are found in staging, a photo has a single known name
+                        "output": generate_file_output_name(current_link,
+                                                            file_name,
+                                                            PHOTO_FILE_EXTENSION) if photo_mode else None
                     })
-                    links_names.append(str(current_link + 1) + "24" + file_name)
                     video_status = True
+                # the event is recording already, room for it is made in the background
+                reservations.request(force=True)
         elif door_state is False and video_status is True:
             time.sleep(config["reed_switch"]["rs_timeout"])
             if impulseCheck is False:
                 door_state = rs.pressed()
-            if door_state is False:
+            if door_state is False and rings:
+                for ring in rings:
+                    finalizer.submit(ring.end_event())
+                video_status = False
+            elif door_state is False:
                 for entry in jobs:
                     proc = entry.get("proc")
-                    stop_event = entry.get("stop_event")
-                    if stop_event:
-                        stop_event.set()
                     try:
                         rc = stop_ffmpeg(proc, logger, timeout=5)
                         if rc is not None and rc not in (0, 255):
@@ -112,9 +192,12 @@ def main():
                     except Exception as e:
                         logger.critical(f"Error while stopping ffmpeg process: {e}")
 
+                for entry in jobs:
+                    if entry["output"] is None:
+                        finalizer.submit(closed_segments(entry["link"], include_open=True))
+                    elif os.path.exists(entry["output"]):
+                        finalizer.submit([entry["output"]])
                 jobs.clear()
-                links_names.clear()
-                move()
                 video_status = False
 
             notifier.notify(WATCH_DOG_NOTIFICATION)
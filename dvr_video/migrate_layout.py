@@ -0,0 +1,67 @@
+"""
+Moves existing materials between the flat layout and the partitioned one (yymmdd/camN/) and switches
+program_options.materials_layout to match. Stop mdvr (or mdvr_rs) first so nothing is published meanwhile:
+
+    python migrate_layout.py partitioned
+    python migrate_layout.py flat
+"""
+import argparse
+import json
+import os
+
+from data.utils import read_config, get_config_path, material_relpath
+from data.constants import DIR_NAME, PROGRAM_OPTIONS_KEY, MATERIALS_LAYOUT_FLAT, MATERIALS_LAYOUT_PARTITIONED
+from data.materials_index import MaterialsIndex
+from data.storage import remove_empty_partitions
+from data.LoggerFactory import DefaultLoggerFactory
+
+logger = DefaultLoggerFactory.create_logger('mdvr_migrate_layout', "migrate_layout.log")
+
+
+def material_files(directory: str) -> list[str]:
+    files = []
+    stack = [directory]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    if not entry.name.startswith('.'):  # staging
+                        stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    files.append(entry.path)
+    return files
+
+
+def migrate(layout: str) -> int:
+    partitioned = layout == MATERIALS_LAYOUT_PARTITIONED
+    moved = 0
+    for path in material_files(DIR_NAME):
+        target = os.path.join(DIR_NAME, material_relpath(os.path.basename(path), partitioned))
+        if target == path:
+            continue
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.rename(path, target)
+        moved += 1
+
+    remove_empty_partitions()
+    MaterialsIndex().reconcile(force=True)
+
+    config = read_config()
+    config[PROGRAM_OPTIONS_KEY]['materials_layout'] = layout
+    with open(get_config_path(), 'w') as file:
+        json.dump(config, file, indent=4)
+    return moved
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Switch the materials directory layout.")
+    parser.add_argument('layout', choices=(MATERIALS_LAYOUT_FLAT, MATERIALS_LAYOUT_PARTITIONED))
+    args = parser.parse_args()
+
+    moved = migrate(args.layout)
+    logger.info(f"Materials migrated to the {args.layout} layout, {moved} files moved.")
+    print(f"{moved} files moved, materials_layout is now {args.layout}.")
+
+
+if __name__ == "__main__":
+    main()
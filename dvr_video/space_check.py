@@ -1,85 +1,83 @@
 import asyncio
 import os
 import pathlib
+import sqlite3
 
-from datetime import datetime
+from watchfiles import awatch
 
 from data.utils import read_config
-from data.constants import DATE_FORMAT, VIDEO_FILE_EXTENSION, DIR_NAME, PROGRAM_OPTIONS_KEY
+from data.constants import DIR_NAME, TEMP_DIR, PREROLL_SPILL_DIR, SPACE_GUARD_INTERVAL, SPACE_GUARD_DEBOUNCE
+from data.eviction import evict, RetentionPolicy
+from data.materials_index import MaterialsIndex
+from data.storage import StorageBudget, load_candidates, materials_usage, staging_usage, free_space, \
+    remove_empty_partitions, set_idle_priority
 from data.LoggerFactory import DefaultLoggerFactory
 
 
-config = read_config()
 logger = DefaultLoggerFactory.create_logger('mdvr_space_check', "space_check.log")
+index = MaterialsIndex()
 
 
-async def extract_date_from_filename(filename: str) -> None | datetime:
-    try:
-        date_str = filename[3:15]
-        date_obj = datetime.strptime(date_str, DATE_FORMAT)
-        return date_obj
-    except ValueError:
-        return None
-
+def bytes_to_free(config: dict) -> int:
+    """
+    Eviction starts when materials plus staging exceed size_folder_limit_gb (the high watermark) or free
+    space on the card drops below min_free_mb, and then frees down to space_low_watermark_percent of the
+    limit, so one run buys room for a while instead of deleting a file per new segment.
+    """
+    budget = StorageBudget(config)
+    used = materials_usage(index) + staging_usage()
+    free = free_space()
+    if used <= budget.high and free >= budget.min_free:
+        return 0
 
-async def find_oldest_video(directory: str) -> tuple[str | None, datetime | None]:
-    oldest_date, oldest_file = None, None
+    logger.info(f"Watermark reached: {used} of {budget.high} bytes used, {free} bytes free.")
+    return max(used - budget.low, budget.min_free + (budget.high - budget.low) - free, 0)
 
-    for filename in os.listdir(directory):
-        if filename.endswith(VIDEO_FILE_EXTENSION):
-            date_obj = await extract_date_from_filename(filename)
-            if date_obj:
-                if oldest_date is None or date_obj < oldest_date:
-                    oldest_date = date_obj
-                    oldest_file = filename
 
-    return oldest_file, oldest_date
+def classes_over_quota(policy: RetentionPolicy) -> list[str]:
+    try:
+        return policy.over_quota(index.usage_by_class())
+    except sqlite3.Error:
+        return []  # load_candidates() falls back to a scan, quotas are enforced on the next watermark run
 
 
-async def get_dir_size(path: str = '.') -> int | float:
-    total = 0
-    with os.scandir(path) as it:
-        for entry in it:
-            if entry.is_file():
-                total += entry.stat().st_size
-            elif entry.is_dir():
-                total += get_dir_size(entry.path)
-    return total
+def run_eviction(to_free: int, policy: RetentionPolicy):
+    candidates, _, indexed = load_candidates(index, logger)
+    on_removed = (lambda path: index.remove(os.path.basename(path))) if indexed else None
+    # evict() counts down from to_free to 0
+    report = evict(candidates, to_free, 0, logger, policy, on_removed)
+    remove_empty_partitions()
+    logger.info(f"Space Check: {report}.")
 
 
-async def from_gb_to_bytes(gb: int) -> int:
-    return gb * 1_000_000_000
+async def check():
+    try:
+        config = read_config()
+        policy = RetentionPolicy(config.get('retention'))
+        to_free = bytes_to_free(config)
+        over_quota = classes_over_quota(policy)
+        if over_quota:
+            logger.info(f"Retention quota exceeded: {', '.join(over_quota)}.")
+        if to_free or over_quota:
+            await asyncio.to_thread(run_eviction, to_free, policy)
+    except Exception as e:
+        logger.error(f"Space Check failed: {e}")
 
 
 async def main():
     pathlib.Path(DIR_NAME).mkdir(parents=True, exist_ok=True)
     pathlib.Path("/etc/mdvr/logs").mkdir(parents=True, exist_ok=True)
     logger.info("Space Check start.")
-    bt = await get_dir_size(DIR_NAME)
-
-    folder_size_limit = config[PROGRAM_OPTIONS_KEY]['size_folder_limit_gb']
-
-    folder_size_limit = await from_gb_to_bytes(folder_size_limit)
-
-    print(folder_size_limit)
-    logger.info(f"{folder_size_limit}")
-
-    if bt > folder_size_limit:
-        while bt > folder_size_limit:
-            print(os.listdir(DIR_NAME))
-            logger.info(f"{os.listdir(DIR_NAME)}")
-
-            oldest_file, oldest_date = await find_oldest_video(DIR_NAME)
-
-            print(oldest_file, oldest_date)
-            logger.info(f"{oldest_file}, {oldest_date}")
-
-            filepath = os.path.join(DIR_NAME, oldest_file)
-
-            os.remove(filepath)
-
-            bt = await get_dir_size(DIR_NAME)
-            logger.info(bt)
+    set_idle_priority(logger)
+
+    await check()
+    # published segments wake the guard up, the timeout also catches staging growing during long events
+    async for _ in awatch(DIR_NAME,
+                          watch_filter=lambda change, path: not path.startswith((TEMP_DIR, PREROLL_SPILL_DIR)),
+                          debounce=SPACE_GUARD_DEBOUNCE,
+                          rust_timeout=SPACE_GUARD_INTERVAL * 1000,
+                          yield_on_timeout=True):
+        await check()
 
 
 if __name__ == "__main__":
@@ -18,3 +18,13 @@ CONFIG_FILENAME = 'data_config.json'
  
 # Path to recorded materials (videos)
 MATERIALS_DIR = "/etc/mdvr/materials/"
+
+# Longest clip /materials/clip will cut, in seconds
+CLIP_MAX_SECONDS = 3600
+
+# Recorded spans closer than this (seconds) are reported as one on /materials/timeline,
+# segment boundaries leave a fraction of a second between files
+TIMELINE_GAP_TOLERANCE = 2
+
+# Files whose mp4 metadata is parsed within one /materials/list request, the rest waits for the next one
+MEDIA_PARSE_LIMIT = 20
@@ -11,8 +11,12 @@ except Exception:
 
 from flask import Blueprint, jsonify, request, send_from_directory
 from dvr_web.utils import load_config
+from dvr_video.data.metrics import read_stats
+from dvr_video.data.materials_index import MaterialsIndex
+from dvr_video.data.storage import StorageBudget, forecast, materials_usage, staging_usage, free_space
 
 api_bp = Blueprint('api', __name__)
+materials_index = MaterialsIndex()
 
 reed_switch_monitor_active = False
 reed_switch_state = {"status": "unknown", "timestamp": 0}
@@ -175,6 +179,19 @@ def api_disk_usage():
             except:
                 pass
 
+    # Forecast for the materials folder from the write rates the recorder publishes
+    try:
+        stats = read_stats() or {}
+        rates = {name: camera.get('bytes_per_second')
+                 for name, camera in stats.get('cameras', {}).items() if name.startswith('camera_')}
+        materials = forecast(rates,
+                             materials_usage(materials_index) + staging_usage(),
+                             free_space(),
+                             StorageBudget(load_config()))
+        materials['reservation'] = stats.get('reservation')
+    except Exception as e:
+        materials = {'error': str(e)}
+
     return jsonify({
         'total': disk.total,
         'used': disk.used,
@@ -184,10 +201,22 @@ def api_disk_usage():
             'read_bytes': read_speed,
             'write_bytes': write_speed
         },
-        'partitions': partitions
+        'partitions': partitions,
+        'materials': materials
     })
 
 
+@api_bp.route('/recorder-stats')
+def api_recorder_stats():
+    # Published by the recording engine every few seconds, see dvr_video/data/metrics.py
+    stats = read_stats()
+    if stats is None:
+        return jsonify({'cameras': {}, 'error': 'Recorder statistics are not available'}), 503
+
+    stats['age'] = int(time.time()) - stats.get('updated', 0)
+    return jsonify(stats)
+
+
 @api_bp.route('/system-temperature')
 def api_system_temperature():
     try:
@@ -1,12 +1,23 @@
+import bisect
 import json
+import logging
 import os
 import subprocess
 import shutil
+import tempfile
 
-from flask import Blueprint, jsonify, request, send_from_directory
+from flask import Blueprint, Response, jsonify, request, send_file, send_from_directory
 from datetime import timedelta, datetime
 
-from dvr_web.constants import VPN_CONFIG_PATH, MATERIALS_DIR
+from dvr_web.constants import VPN_CONFIG_PATH, MATERIALS_DIR, CLIP_MAX_SECONDS, TIMELINE_GAP_TOLERANCE, \
+    MEDIA_PARSE_LIMIT
+from dvr_video.data.constants import VIDEO_FILE_EXTENSION
+from dvr_video.data.materials_index import MaterialsIndex
+from dvr_video.data.utils import duration_to_seconds
+from dvr_video.data.thumbnails import ThumbnailCache, ThumbnailWorker
+from dvr_video.data.mp4info import read_mp4_info
+from dvr_video.data.timeline import build_timelines
+from dvr_video.data.upload_shaping import read_upload_stats
 
 # Paths for preserving and restoring original WireGuard config
 BACKUP_DIR = "/etc/mdvr"
@@ -15,6 +26,11 @@ from dvr_web.utils import generate_nginx_configs, get_camera_ports, load_config,
 
 
 web_bp = Blueprint('web', __name__)
+logger = logging.getLogger('dvr_web')
+materials_index = MaterialsIndex()
+thumbnail_cache = ThumbnailCache()
+# cache misses are rendered one at a time in a thread of dvr_web, never in the request
+thumbnail_worker = ThumbnailWorker(logger, thumbnail_cache)
 
 
 @web_bp.route('/get-camera-ports')
@@ -650,6 +666,8 @@ def save_ftp_config():
         ftp_data = data.get('ftp', {})
         print(f"[DEBUG FTP] FTP data to save: {ftp_data}")
         config['ftp'] = {
+            # keeps settings the form does not edit, like the upload session count
+            **config.get('ftp', {}),
             "server": ftp_data.get('server', ''),
             "port": ftp_data.get('port', 21),
             "user": ftp_data.get('user', ''),
@@ -701,6 +719,34 @@ def set_upload_enabled():
         return jsonify({"success": False, "error": str(e)}), 500
 
 
+@web_bp.route('/upload-rate', methods=['GET', 'POST'])
+def upload_rate():
+    """Upload bandwidth limit, picked up by a running mdvr_upload within seconds.
+    Request JSON (POST): {"kbps": 256}, 0 means unlimited
+    Response JSON: {"success": bool, "kbps": int, "stats": {...} | null}
+    stats is published by mdvr_upload while it runs: effective rate after VPN latency backoff, rtt_ms, ...
+    """
+    try:
+        config = load_config()
+        if request.method == 'POST':
+            data = request.get_json(silent=True) or {}
+            kbps = int(data.get('kbps', 0))
+            if kbps < 0:
+                return jsonify({"success": False, "error": "kbps must be 0 or more"}), 400
+            config.setdefault('ftp', {})['rate_limit_kbps'] = kbps
+            with open(get_config_path(), 'w') as file:
+                json.dump(config, file, indent=4)
+        return jsonify({
+            "success": True,
+            "kbps": int(config.get('ftp', {}).get('rate_limit_kbps', 0)),
+            "stats": read_upload_stats()
+        })
+    except (TypeError, ValueError) as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+
 @web_bp.route('/set-vpn-enabled', methods=['POST'])
 def set_vpn_enabled():
     """Enable/disable WireGuard service wg-quick@wg0 and start/stop accordingly.
@@ -783,6 +829,9 @@ def save_video_options():
             seconds = timedelta(hours=h, minutes=m, seconds=s).total_seconds()
             update_watchdog(int(seconds * 10))
 
+        if 'continuous' in data:
+            config['video_options']['continuous'] = 1 if data.get('continuous') else 0
+
         photo_timeout = data.get('photo_timeout')
 
         if photo_timeout:
@@ -1066,74 +1115,260 @@ def list_materials():
             # end of day
             date_to = datetime(year=date_to.year, month=date_to.month, day=date_to.day, hour=23, minute=59, second=59)
 
-        video_exts = {'.mp4', '.mkv', '.avi', '.mov', '.m3u8', '.ts'}
+        # the recorder keeps the index up to date, the directory is only scanned again after changes by hand
+        materials_index.refresh(MATERIALS_DIR)
+        rows = materials_index.list_between(date_from, date_to, kind='video')
+        media = _parse_missing_media(rows)
         items = []
-        for name in sorted(os.listdir(MATERIALS_DIR)):
-            path = os.path.join(MATERIALS_DIR, name)
-            if not os.path.isfile(path):
-                continue
-            ext = os.path.splitext(name)[1].lower()
-            if ext not in video_exts:
-                continue
-            stat = os.stat(path)
-
-            # Parse filename according to dvr_video convention: c + '24' + yymmdd + [hhmmss]
-            base = os.path.splitext(name)[0]
-            display_name = name
-            cam = None
-            date_str = None
-            time_str = None
-            recorded_dt = None
-            try:
-                if len(base) >= 9 and base[1:3] == '24':
-                    cam = int(base[0])
-                    yymmdd = base[3:9]
-                    # Convert to DD.MM.YYYY
-                    yy = int(yymmdd[0:2])
-                    mm = int(yymmdd[2:4])
-                    dd = int(yymmdd[4:6])
-                    yyyy = 2000 + yy
-                    date_str = f"{dd:02d}.{mm:02d}.{yyyy}"
-                    if len(base) >= 15:
-                        hh = int(base[9:11])
-                        mi = int(base[11:13])
-                        ss = int(base[13:15])
-                        time_str = f"{hh:02d}:{mi:02d}:{ss:02d}"
-                        recorded_dt = datetime(year=yyyy, month=mm, day=dd, hour=hh, minute=mi, second=ss)
-                    else:
-                        recorded_dt = datetime(year=yyyy, month=mm, day=dd, hour=0, minute=0, second=0)
-                    if cam and date_str:
-                        display_name = f"Камера {cam} — {date_str}" + (f" {time_str}" if time_str else "")
-            except Exception:
-                # Fallback to original name on any parsing error
-                pass
-
-            if recorded_dt is None:
-                recorded_dt = datetime.fromtimestamp(int(stat.st_mtime))
-
-            # Apply filters
-            if date_from and recorded_dt < date_from:
-                continue
-            if date_to and recorded_dt > date_to:
-                continue
+        for row in rows:
+            name = row["name"]
+            cam = row["camera"]
+            recorded_dt = datetime.fromtimestamp(row["start_ts"])
+            date_str = recorded_dt.strftime("%d.%m.%Y") if cam else None
+            time_str = recorded_dt.strftime("%H:%M:%S") if cam else None
+            display_name = f"Камера {cam} — {date_str} {time_str}" if cam else name
 
             items.append({
                 "name": name,
-                "size": stat.st_size,
-                "mtime": int(stat.st_mtime),
-                "url": f"/materials/file/{name}",
+                "size": row["size"],
+                "mtime": row["mtime"],
+                "url": f"/materials/file/{row['path']}",
                 "display_name": display_name,
                 "camera": cam,
                 "recorded_date": date_str,
                 "recorded_time": time_str,
-                "recorded_ts": int(recorded_dt.timestamp())
+                "recorded_ts": row["start_ts"],
+                "duration": media[name]["duration"] if name in media else row["duration"],
+                "event_id": row["event_id"],
+                # mtime in the query makes the urls change with the file, so previews can be cached forever
+                "poster": f"/materials/preview/poster/{name}?v={row['mtime']}",
+                "sprite": f"/materials/preview/sprite/{name}?v={row['mtime']}"
             })
         return jsonify({"files": items})
     except Exception as e:
         return jsonify({"files": [], "error": str(e)}), 500
 
 
+def _parse_missing_media(rows, limit: int = MEDIA_PARSE_LIMIT) -> dict[str, dict]:
+    """
+    Parses the boxes of files indexed without metadata (rebuilt index, files copied in) and caches the result,
+    at most `limit` files per request, the rest on the next ones. A file that cannot be parsed (no video
+    track, truncated moov, not an mp4) is stored with codec '' so it is only tried once.
+    """
+    media = {}
+    for row in rows:
+        if len(media) >= limit:
+            break
+        if row["codec"] is not None or row["duration"] is not None:
+            continue
+        info = None
+        if row["name"].endswith(VIDEO_FILE_EXTENSION):
+            try:
+                info = read_mp4_info(os.path.join(MATERIALS_DIR, row["path"]))
+            except OSError:
+                continue  # gone or unreadable right now, not a reason to give up on it
+            except ValueError:
+                pass
+        media[row["name"]] = info or {"codec": ""}
+    if media:
+        materials_index.set_media(media)
+    return {name: {"duration": info.get("duration")} for name, info in media.items()}
+
+
+@web_bp.route('/materials/info/<name>')
+def get_material_info(name):
+    """Duration, codec, resolution and keyframe times (seconds from the start) of a video, for seeking."""
+    row = materials_index.get(name)
+    if row is None or row["kind"] != 'video':
+        return jsonify({"error": "File not found"}), 404
+    if row["codec"] is None and row["duration"] is None:
+        _parse_missing_media([row])
+        row = materials_index.get(name)
+    return jsonify({
+        "name": name,
+        "duration": row["duration"],
+        "codec": row["codec"] or None,
+        "width": row["width"],
+        "height": row["height"],
+        "keyframes": materials_index.keyframes(name) or [],
+    })
+
+
+@web_bp.route('/materials/timeline')
+def get_materials_timeline():
+    """What each camera recorded on a day: merged spans and the gaps between them, as unix timestamps.
+
+    Query: date=2025-01-09, optional camera=2 and at=14:03:10 (segments recorded at that moment).
+    """
+    try:
+        day = datetime.strptime((request.args.get('date') or '').strip(), "%Y-%m-%d")
+        camera = int(request.args['camera']) if request.args.get('camera') else None
+        at = datetime.combine(day.date(), datetime.strptime(request.args['at'].strip(), "%H:%M:%S").time()) \
+            if request.args.get('at') else None
+    except ValueError:
+        return jsonify({"error": "Expected date=YYYY-MM-DD, optional camera and at=HH:MM:SS"}), 400
+
+    config = load_config()
+    max_duration = duration_to_seconds(config['video_options']['video_duration'])
+    day_start = day.timestamp()
+    day_end = (day + timedelta(days=1)).timestamp()
+    # segments started before midnight may still run into the day
+    rows = materials_index.list_between(datetime.fromtimestamp(day_start - max_duration),
+                                        datetime.fromtimestamp(day_end), kind='video')
+    timelines = build_timelines(rows, max_duration, TIMELINE_GAP_TOLERANCE)
+
+    cameras = sorted(set(range(1, len(config.get('camera_list', [])) + 1)) | set(timelines))
+    if camera is not None:
+        cameras = [camera]
+
+    result = {}
+    for cam in cameras:
+        timeline = timelines.get(cam)
+        spans = timeline.coverage(day_start, day_end) if timeline else []
+        gaps = timeline.gaps(day_start, day_end) if timeline else [(day_start, day_end)]
+        entry = {
+            "spans": [{"start": start, "end": end} for start, end in spans],
+            "gaps": [{"start": start, "end": end} for start, end in gaps],
+            "recorded_seconds": round(sum(end - start for start, end in spans), 3),
+        }
+        if at is not None:
+            entry["at"] = [{"name": row["name"], "start": row["start_ts"], "offset": at.timestamp() - row["start_ts"]}
+                           for row in (timeline.at(at.timestamp()) if timeline else [])]
+        result[str(cam)] = entry
+
+    return jsonify({"date": day.strftime("%Y-%m-%d"), "start": day_start, "end": day_end, "cameras": result})
+
+
 @web_bp.route('/materials/file/<path:filename>')
 def get_material_file(filename):
     # Serve file directly from materials directory
     return send_from_directory(MATERIALS_DIR, filename, as_attachment=False)
+
+
+@web_bp.route('/materials/preview/<kind>/<name>')
+def get_material_preview(kind, name):
+    """
+    Poster frame or sprite strip of a video, the recorder renders both when it publishes the file. A cache miss
+    (files copied in by hand, a cleared cache) queues the requested preview on the worker of dvr_web and answers
+    202, the page asks again later.
+    """
+    if kind not in ('poster', 'sprite'):
+        return jsonify({"error": "Unknown preview"}), 404
+    row = materials_index.get(name)
+    if row is None or row["kind"] != 'video':
+        return jsonify({"error": "File not found"}), 404
+
+    path = thumbnail_cache.get(name, row["mtime"], kind)
+    if path is None:
+        thumbnail_worker.request(os.path.join(MATERIALS_DIR, row["path"]), row["duration"], (kind,))
+        response = jsonify({"status": "rendering"})
+        response.status_code = 202
+        response.headers['Retry-After'] = '5'
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
+    response = send_file(path, mimetype='image/jpeg', max_age=31536000)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+
+def _keyframe_before(name: str, offset: float) -> float:
+    """Latest keyframe at or before offset, where a stream copy of the segment can actually start."""
+    keyframes = materials_index.keyframes(name)
+    if not keyframes:
+        return offset  # not parsed yet, ffmpeg snaps back on its own
+    return keyframes[max(bisect.bisect_right(keyframes, offset) - 1, 0)]
+
+
+def _clip_concat_list(segments, start: datetime, end: datetime) -> tuple[str, float]:
+    """
+    ffconcat script that cuts the first and last segment, and the moment the clip really starts: inpoint is
+    snapped back to the previous keyframe because of -c copy.
+    """
+    lines = ["ffconcat version 1.0"]
+    clip_start = max(start.timestamp(), segments[0]["start_ts"])
+    for i, row in enumerate(segments):
+        path = os.path.join(MATERIALS_DIR, row["path"]).replace("'", "'\\''")
+        lines.append(f"file '{path}'")
+        if i == 0 and start.timestamp() > row["start_ts"]:
+            inpoint = _keyframe_before(row["name"], start.timestamp() - row["start_ts"])
+            clip_start = row["start_ts"] + inpoint
+            lines.append(f"inpoint {inpoint:.3f}")
+        if i == len(segments) - 1 and end.timestamp() - row["start_ts"] < (row["duration"] or float('inf')):
+            lines.append(f"outpoint {end.timestamp() - row['start_ts']:.3f}")
+    return "\n".join(lines) + "\n", clip_start
+
+
+@web_bp.route('/materials/clip')
+def get_material_clip():
+    """Cut one camera between two moments out of the recorded segments without re-encoding.
+
+    Query: camera=2&start=2025-01-09T14:03:10&end=2025-01-09T14:05:40
+    The clip is a fragmented mp4 streamed while ffmpeg produces it.
+    """
+    try:
+        camera = int(request.args.get('camera', ''))
+        start = datetime.fromisoformat((request.args.get('start') or '').strip())
+        end = datetime.fromisoformat((request.args.get('end') or '').strip())
+    except ValueError:
+        return jsonify({"error": "Expected camera, start and end (YYYY-MM-DDTHH:MM:SS)"}), 400
+    if not 0 < (end - start).total_seconds() <= CLIP_MAX_SECONDS:
+        return jsonify({"error": f"Clip must be between 1 and {CLIP_MAX_SECONDS} seconds long"}), 400
+
+    max_duration = duration_to_seconds(load_config()['video_options']['video_duration'])
+    segments = materials_index.covering(camera, start, end, max_duration)
+    if not segments:
+        return jsonify({"error": "Nothing was recorded in this interval"}), 404
+
+    # the concat script comes in on stdin and the clip goes out on stdout, nothing touches the card;
+    # errors go to a temporary file so a chatty ffmpeg never blocks on a full pipe
+    errors = tempfile.TemporaryFile()
+    proc = subprocess.Popen([
+        "ffmpeg", "-hide_banner", "-loglevel", "error",
+        "-f", "concat", "-safe", "0", "-protocol_whitelist", "file,pipe", "-i", "pipe:0",
+        "-c", "copy", "-f", "mp4", "-movflags", "frag_keyframe+empty_moov+default_base_moof",
+        "pipe:1"
+    ], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=errors)
+
+    def stop():
+        # the client may disconnect before the end
+        proc.kill()
+        proc.wait()
+        proc.stdout.close()
+        errors.close()
+
+    streaming = False
+    try:
+        concat_list, clip_start = _clip_concat_list(segments, start, end)
+        try:
+            proc.stdin.write(concat_list.encode())
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass  # ffmpeg is already gone, the empty output below says so
+
+        first = proc.stdout.read(64 * 1024)
+        if not first:
+            proc.wait()
+            errors.seek(0)
+            logger.error(f"Clip of camera {camera} from {start} to {end} failed, ffmpeg exited with "
+                         f"{proc.returncode}: {errors.read().decode(errors='replace').strip()}")
+            return jsonify({"error": "Failed to cut the clip"}), 500
+
+        def generate():
+            yield first
+            while chunk := proc.stdout.read(64 * 1024):
+                yield chunk
+
+        filename = f"camera{camera}_{start.strftime('%Y%m%d_%H%M%S')}_{end.strftime('%H%M%S')}.mp4"
+        response = Response(generate(), mimetype='video/mp4',
+                            headers={"Content-Disposition": f'inline; filename="{filename}"',
+                                     # lets the player map clip time back to wall clock time
+                                     "X-Clip-Start": datetime.fromtimestamp(clip_start).isoformat(
+                                         timespec='milliseconds')})
+        # runs when the response is closed, also when the client went away before the first byte was sent
+        response.call_on_close(stop)
+        streaming = True
+        return response
+    finally:
+        if not streaming:
+            stop()
@@ -99,6 +99,27 @@ async function loadMaterials(force = false) {
       rightSpan.style.color = '#8aa0b5';
       rightSpan.style.fontSize = '0.9em';
 
+      if (f.poster) {
+        const poster = document.createElement('img');
+        poster.src = f.poster;
+        poster.loading = 'lazy';
+        poster.alt = '';
+        poster.style.width = '80px';
+        poster.style.marginRight = '8px';
+        poster.style.borderRadius = '3px';
+        // 202 while the preview is rendered in the background, ask again a few times
+        let retries = 3;
+        poster.onerror = () => {
+          if (retries-- > 0) {
+            setTimeout(() => { poster.src = `${f.poster}&retry=${retries}`; }, 5000);
+          } else {
+            poster.remove();
+          }
+        };
+        li.appendChild(poster);
+        nameSpan.style.flex = '1';
+      }
+
       li.appendChild(nameSpan);
       li.appendChild(rightSpan);
 
@@ -0,0 +1,109 @@
+"""
+Upload throughput of the FTP session pool against a local aioftp server, for 1..N sessions.
+
+The server keeps files in memory and reads uploads (STOR) at most at --speed KiB/s per data connection.
+The control connection goes through a proxy that delays every packet by --latency ms, like the LTE link
+the devices upload over.
+
+    python scripts/ftp_pool_benchmark.py --files 40 --size 256 --sessions 1 2 4 8
+"""
+import argparse
+import asyncio
+import logging
+import os
+import pathlib
+import sys
+import tempfile
+import time
+
+import aioftp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dvr_video'))
+
+from data.ftp_pool import ThroughputTuner, UploadPool  # noqa: E402
+
+
+async def delayed_pipe(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, latency: float):
+    queue = asyncio.Queue()
+
+    async def forward():
+        while True:
+            due, data = await queue.get()
+            if data is None:
+                break
+            await asyncio.sleep(max(due - time.monotonic(), 0))
+            writer.write(data)
+            await writer.drain()
+        writer.close()
+
+    sender = asyncio.create_task(forward())
+    while data := await reader.read(65536):
+        queue.put_nowait((time.monotonic() + latency, data))
+    queue.put_nowait((0, None))
+    await sender
+
+
+async def start_latency_proxy(target_port: int, latency: float) -> asyncio.AbstractServer:
+    async def handle(client_reader, client_writer):
+        server_reader, server_writer = await asyncio.open_connection('127.0.0.1', target_port)
+        await asyncio.gather(delayed_pipe(client_reader, server_writer, latency / 2),
+                             delayed_pipe(server_reader, client_writer, latency / 2),
+                             return_exceptions=True)
+
+    return await asyncio.start_server(handle, '127.0.0.1', 0)
+
+
+async def benchmark(sessions: int, files: list[pathlib.Path], port: int) -> float:
+    def connect():
+        return aioftp.Client.context('127.0.0.1', port, 'bench', 'bench', socket_timeout=60)
+
+    async def upload(client: aioftp.Client, path: pathlib.Path) -> int:
+        await client.upload(path, f"/{sessions}", write_into=False)
+        return path.stat().st_size
+
+    async with connect() as client:
+        await client.make_directory(f"/{sessions}")
+
+    pool = UploadPool(connect, upload, logging.getLogger('benchmark'), ThroughputTuner(sessions, sessions, auto=False))
+    started = time.monotonic()
+    await pool.run(files)
+    return pool.bytes / (time.monotonic() - started)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--files', type=int, default=40)
+    parser.add_argument('--size', type=int, default=256, help="KiB per file")
+    parser.add_argument('--speed', type=int, default=512, help="upload KiB/s per connection")
+    parser.add_argument('--latency', type=int, default=150, help="round trip of the control connection, ms")
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    server = aioftp.Server([aioftp.User('bench', 'bench', permissions=[aioftp.Permission('/', writable=True)])],
+                           path_io_factory=aioftp.MemoryPathIO,
+                           read_speed_limit_per_connection=args.speed * 1024)
+    await server.start('127.0.0.1', 0)
+    server_port = server.server.sockets[0].getsockname()[1]
+    proxy = await start_latency_proxy(server_port, args.latency / 1000)
+    port = proxy.sockets[0].getsockname()[1]
+
+    with tempfile.TemporaryDirectory() as directory:
+        files = []
+        for i in range(args.files):
+            path = pathlib.Path(directory, f"{i:04d}.mp4")
+            path.write_bytes(os.urandom(args.size * 1024))
+            files.append(path)
+
+        print(f"{args.files} files of {args.size} KiB, {args.speed} KiB/s per connection, {args.latency} ms RTT")
+        baseline = None
+        for sessions in args.sessions:
+            rate = await benchmark(sessions, files, port)
+            baseline = baseline or rate
+            print(f"{sessions:3d} sessions: {rate / 1024:8.1f} KiB/s  x{rate / baseline:.2f}")
+
+    proxy.close()
+    await server.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())